@@ -2,25 +2,77 @@ CREATE DATABASE isit;
 
 \c isit;
 
+-- file_data пустой, если изображение хранится в хранилище файлов (BLOB_BACKEND=fs) под именем file_hash
+
 CREATE TABLE IF NOT EXISTS scrapped_images (
     id SERIAL PRIMARY KEY,
     file_name TEXT,
     file_hash TEXT UNIQUE,
-    file_data BYTEA
+    file_data BYTEA,
+    phash BIGINT
 );
 
 CREATE TABLE IF NOT EXISTS selected_images (
     id SERIAL PRIMARY KEY,
     scrapped_image_id INT UNIQUE,
     file_data BYTEA,
+    file_hash TEXT,
+    predicted_class TEXT,
+    predicted_class_version TEXT,
     FOREIGN KEY (scrapped_image_id) REFERENCES scrapped_images(id)
 );
 
 CREATE TABLE IF NOT EXISTS pyramid_images (
     id SERIAL PRIMARY KEY,
     file_data BYTEA,
+    file_hash TEXT,
     selected_image_id_1 INT,
     selected_image_id_2 INT,
     FOREIGN KEY (selected_image_id_1) REFERENCES selected_images(id),
     FOREIGN KEY (selected_image_id_2) REFERENCES selected_images(id)
 );
+
+CREATE TABLE IF NOT EXISTS image_features (
+    selected_image_id INT,
+    model_version TEXT,
+    data BYTEA,
+    PRIMARY KEY (selected_image_id, model_version),
+    FOREIGN KEY (selected_image_id) REFERENCES selected_images(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS crawl_state (
+    url TEXT PRIMARY KEY,
+    file_hash TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at TIMESTAMP DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id SERIAL PRIMARY KEY,
+    job_type TEXT NOT NULL,
+    params JSONB,
+    dedupe_key TEXT,
+    state TEXT NOT NULL DEFAULT 'queued',
+    processed INT NOT NULL DEFAULT 0,
+    total INT,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT now(),
+    started_at TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT now(),
+    heartbeat_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+-- Одинаковое задание не может стоять в очереди или выполняться дважды
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_dedupe_key ON jobs (dedupe_key) WHERE state IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (job_type, id) WHERE state = 'queued';
+
+-- Уменьшенные копии изображений selected_images: меньшая сторона равна size, пропорции сохранены
+CREATE TABLE IF NOT EXISTS image_renditions (
+    selected_image_id INT,
+    size INT,
+    data BYTEA,
+    PRIMARY KEY (selected_image_id, size),
+    FOREIGN KEY (selected_image_id) REFERENCES selected_images(id) ON DELETE CASCADE
+);
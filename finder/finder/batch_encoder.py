@@ -0,0 +1,136 @@
+import asyncio, os, time, torch
+from finder.utils import database
+from concurrent.futures import ThreadPoolExecutor
+
+def configure_threads():
+    # Число потоков torch для forward pass, по умолчанию - все ядра
+    num_threads = int(os.getenv("TORCH_NUM_THREADS", os.cpu_count()))
+    torch.set_num_threads(num_threads)
+    return num_threads
+
+def create_pool():
+    # Пул воркеров для декодирования и предобработки изображений
+    return ThreadPoolExecutor(max_workers=int(os.getenv("ENCODER_WORKERS", os.cpu_count())), thread_name_prefix="encoder")
+
+def create_background_pool():
+    # Пул индексации: ограничивает число одновременных задач фоновой индексации и переиндексации
+    return ThreadPoolExecutor(max_workers=int(os.getenv("INDEX_WORKERS", 2)), thread_name_prefix="indexer")
+
+async def _batches(rows, batch_size):
+    # Разбиение потока строк (обычного или асинхронного) на пакеты
+    batch = []
+    if hasattr(rows, "__aiter__"):
+        async for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    else:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def _preprocess(ctx, preprocess, image_id, file_data):
+    try:
+        return image_id, preprocess(file_data)
+    except Exception as e:
+        ctx.logger.error(f"Ошибка при предобработке изображения {image_id}: {e}")
+        return image_id, None
+
+async def load_file_data(ctx, rows, rendition=None):
+    # Байты изображений: из строки, из кэша изображений или одним запросом к базе для остальных.
+    # rendition - размер уменьшенной копии из image_renditions, для изображений без копии берется оригинал
+    kind = f"file_data:{rendition}" if rendition else "file_data"
+    file_data = {}
+    missing_ids = []
+    for row in rows:
+        data = None if rendition else row.get('file_data')
+        if data is None:
+            data = ctx.image_cache.get(row['id'], row.get('file_hash'), kind)
+        if data is None:
+            missing_ids.append(row['id'])
+        else:
+            file_data[row['id']] = data
+    if missing_ids:
+        hashes = {row['id']: row.get('file_hash') for row in rows}
+        async with ctx.db_handle.acquire() as conn:
+            fetched = list(await database.fetch_renditions(conn, missing_ids, rendition)) if rendition else []
+            fetched_ids = {row['id'] for row in fetched}
+            originals = [image_id for image_id in missing_ids if image_id not in fetched_ids]
+            if originals:
+                fetched += await database.fetch_many_by_ids(conn, originals)
+        for row in fetched:
+            file_data[row['id']] = row['file_data']
+            ctx.image_cache.put(row['id'], hashes[row['id']], kind, row['file_data'])
+    return file_data
+
+async def prepare_batch(ctx, rows, preprocess, kind, rendition=None, pool=None):
+    # Предобработанные данные для строк (id, file_hash[, file_data]). Сначала проверяется кэш изображений
+    # по id, хэшу содержимого и виду предобработки, в базу идут только промахи.
+    # pool - пул для предобработки, по умолчанию пул запросов ctx.compute.threads
+    loop = asyncio.get_running_loop()
+    prepared = {}
+    missing = []
+    for row in rows:
+        item = ctx.image_cache.get(row['id'], row.get('file_hash'), kind)
+        if item is None:
+            missing.append(row)
+        else:
+            prepared[row['id']] = item
+
+    if missing:
+        file_data = await load_file_data(ctx, missing, rendition)
+        hashes = {row['id']: row.get('file_hash') for row in missing}
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool or ctx.compute.threads, _preprocess, ctx, preprocess, image_id, data)
+            for image_id, data in file_data.items()
+        ))
+        for image_id, item in results:
+            if item is not None:
+                prepared[image_id] = item
+                ctx.image_cache.put(image_id, hashes[image_id], kind, item)
+    return [(row['id'], prepared[row['id']]) for row in rows if row['id'] in prepared]
+
+def _forward(forward, image_ids, items):
+    with torch.no_grad():
+        outputs = forward(list(items))
+    return list(zip(image_ids, outputs))
+
+async def encode_batches(ctx, rows, preprocess, forward, name="encoder", batch_size=None, rendition=None):
+    # Пакетное кодирование строк selected_images (id, file_hash[, file_data]), результаты отдаются по пакетам:
+    # preprocess(file_data) -> тензор одного изображения, выполняется на пуле воркеров, результат кэшируется
+    # в ctx.image_cache под видом name;
+    # forward(список тензоров пакета) -> результаты для каждого изображения пакета.
+    # Forward pass текущего пакета идет параллельно с декодированием следующего.
+    # Кодирование выполняется на пуле индексации, пул запросов остается свободным для поиска
+    loop = asyncio.get_running_loop()
+    batch_size = batch_size or int(os.getenv("ENCODER_BATCH_SIZE", 32))
+    pool = ctx.compute.background
+    encoded = 0
+    forward_future = None
+    started = time.perf_counter()
+
+    async for batch in _batches(rows, batch_size):
+        prepared = await prepare_batch(ctx, batch, preprocess, name, rendition, pool)
+
+        done = await forward_future if forward_future is not None else None
+        forward_future = None
+        if prepared:
+            image_ids, items = zip(*prepared)
+            forward_future = loop.run_in_executor(pool, _forward, forward, image_ids, items)
+        if done:
+            encoded += len(done)
+            yield done
+
+    if forward_future is not None:
+        done = await forward_future
+        encoded += len(done)
+        yield done
+
+    elapsed = time.perf_counter() - started
+    if encoded:
+        ctx.logger.info(f"{name}: закодировано {encoded} изображений за {elapsed:.2f} с ({encoded / elapsed:.1f} изобр./с)")
@@ -1,47 +1,40 @@
-import tqdm, cv2
+import tqdm, cv2, os, threading, asyncio, math, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from finder.utils import database, constants
+from finder import features, batch_encoder, lab_store, decode
 import numpy as np
 from skimage.color import deltaE_ciede2000
 
-async def fetch_image_data(ctx, image_id):
-    # Получение данных изображения из базы данных по его ID.
-    try:
-        ctx.logger.info(f"Выполняется запрос данных изображения для ID {image_id}")
-        async with ctx.db_handle.acquire() as conn:
-            result = await database.fetch_row_selected_image(conn, image_id)
-        if result is None:
-            ctx.logger.warning(f"Данные изображения не найдены для ID {image_id}")
-        else:
-            ctx.logger.info(f"Данные изображения успешно загружены для ID {image_id}")
-        return result
-    except Exception as e:
-        ctx.logger.error(f"Ошибка при запросе данных изображения для ID {image_id}: {e}")
-        return None
-
 def resize_image(image, target_size=(constants.SIZE_256, constants.SIZE_256)):
     # Изменение размера изображения до указанного размера.
     return cv2.resize(image, target_size)
 
+def lab_thumbnail(image_data, reduced=True):
+    # Миниатюра 256x256 в пространстве CIELAB (uint8) для хранилища lab_store.
+    # Декодер сразу уменьшает изображение так, чтобы меньшая сторона была не меньше 256
+    image = decode.cv2_decode(image_data, constants.SIZE_256 if reduced else None, cv2.IMREAD_UNCHANGED)
+    image_resized = resize_image(image)
+    return cv2.cvtColor(image_resized, cv2.COLOR_BGR2Lab)
+
 def bgra_2_lab(image_data, ctx):
     # Преобразование изображения из цветового пространства BGRA в CIELAB.
     try:
-        image_array = np.frombuffer(image_data, dtype=np.uint8)
-        image = cv2.imdecode(image_array, cv2.IMREAD_UNCHANGED)
-        image_resized = resize_image(image)
-        lab_img = cv2.cvtColor(image_resized, cv2.COLOR_BGR2Lab)
-        return lab_img.astype(np.float32)
+        return lab_thumbnail(image_data).astype(np.float32)
     except Exception as e:
         ctx.logger.error(f"Ошибка при преобразовании изображения в цветовое пространство Lab: {e}")
         return None
 
+def ab_histogram(image):
+    hist_a = cv2.calcHist([image], [1], None, [32], [0, 256])
+    hist_a = cv2.normalize(hist_a, hist_a).flatten()
+    hist_b = cv2.calcHist([image], [2], None, [32], [0, 256])
+    hist_b = cv2.normalize(hist_b, hist_b).flatten()
+    return np.concatenate([hist_a, hist_b])
+
 def histogram_mask(image, ctx):
     # Вычисление маски гистограммы изображения.
     try:
-        hist_a = cv2.calcHist([image], [1], None, [32], [0, 256])
-        hist_a = cv2.normalize(hist_a, hist_a).flatten()
-        hist_b = cv2.calcHist([image], [2], None, [32], [0, 256])
-        hist_b = cv2.normalize(hist_b, hist_b).flatten()
-        return np.concatenate([hist_a, hist_b])
+        return ab_histogram(image)
     except Exception as e:
         ctx.logger.error(f"Ошибка при вычислении маски гистограммы изображения: {e}")
         return None
@@ -53,48 +46,142 @@ def f1_score(precision, recall):
     except ZeroDivisionError:
         return 0
 
-async def get_top_similar_imgs(main_image_id, ctx, top_count=3):
-    # Получение топовых похожих изображений по заданному ID основного изображения.
+class AbHistogramIndex:
+    # Гистограммы каналов a/b (результат histogram_mask) для всего корпуса - дешевый этап отбора кандидатов
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._view = (np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32))
+
+    def __len__(self):
+        return len(self._view[0])
+
+    def ids(self):
+        return self._view[0]
+
+    def add(self, ids, hists):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if ids.size == 0:
+            return
+        hists = np.asarray(hists, dtype=np.float32).reshape(ids.size, -1)
+        with self._lock:
+            current_ids, current_hists = self._view
+            keep = ~np.isin(current_ids, ids)
+            current_hists = current_hists[keep] if current_hists.size else current_hists.reshape(0, hists.shape[1])
+            self._view = (np.concatenate([current_ids[keep], ids]), np.concatenate([current_hists, hists]))
+
+    def remove(self, ids):
+        with self._lock:
+            current_ids, current_hists = self._view
+            keep = ~np.isin(current_ids, np.asarray(ids, dtype=np.int64))
+            if not keep.all():
+                self._view = (current_ids[keep], current_hists[keep])
+
+    def clear(self):
+        with self._lock:
+            self._view = (np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32))
+
+    def shortlist(self, target_hist, size, exclude_id):
+        # Кандидаты с наибольшим пересечением гистограмм (cv2.HISTCMP_INTERSECT) для всего корпуса сразу
+        ids, hists = self._view
+        candidates = np.flatnonzero(ids != exclude_id)
+        size = min(size, candidates.size)
+        if size <= 0:
+            return []
+        scores = np.minimum(hists[candidates], target_hist).sum(axis=1)
+        top = candidates[np.argpartition(-scores, size - 1)[:size]]
+        return ids[top].tolist()
+
+def lab_histogram(image_data, ctx):
+    # Гистограмма a/b для индексации, считается один раз на изображение
+    lab_img = bgra_2_lab(image_data, ctx)
+    if lab_img is None:
+        raise ValueError("Не удалось преобразовать изображение в цветовое пространство Lab")
+    hist = histogram_mask(lab_img, ctx)
+    if hist is None:
+        raise ValueError("Не удалось вычислить маску гистограммы")
+    return hist
+
+def create_pool():
+    # Пул процессов для расчета CIEDE2000 по частям хранилища миниатюр
+    return ProcessPoolExecutor(max_workers=ciede_workers(), mp_context=multiprocessing.get_context("spawn"))
+
+def ciede_workers():
+    return int(os.getenv("CIEDE_WORKERS", os.cpu_count()))
+
+async def sync_thumbnails(ctx, current_ids=None):
+    # Поддержание хранилища миниатюр Lab в соответствии с selected_images
+    if current_ids is None:
+        current_ids = await features.current_image_ids(ctx)
+    await ctx.compute.run_background(ctx.lab_store.remove, np.setdiff1d(ctx.lab_store.ids(), current_ids))
+
+    missing_ids = np.setdiff1d(current_ids, ctx.lab_store.ids())
+    if missing_ids.size:
+        # Уменьшенные копии 256 загружаются по пакетам через кэш изображений
+        async with ctx.db_handle.acquire() as conn:
+            rows = await database.fetch_many_by_ids(conn, missing_ids.tolist(), with_data=False)
+        async for encoded in batch_encoder.encode_batches(ctx, rows, lab_thumbnail, lambda thumbnails: thumbnails, name="lab-thumbnails", rendition=constants.SIZE_256):
+            image_ids, thumbnails = zip(*encoded)
+            # Запись в файл и fsync выполняются вне цикла событий
+            await ctx.compute.run_background(ctx.lab_store.add, image_ids, thumbnails)
+
+async def index_new_images(ctx, current_ids=None):
+    if current_ids is None:
+        current_ids = await features.current_image_ids(ctx)
+    await features.sync_index(ctx, ctx.ciede_index, constants.LAB_HIST_FEATURE_VERSION, lambda image_data: lab_histogram(image_data, ctx), lambda hists: hists, rendition=constants.SIZE_256, current_ids=current_ids)
+    await sync_thumbnails(ctx, current_ids)
+
+def score_chunk(data_path, image_ids, slots, im1_lab, im1_hist):
+    # Точная оценка CIEDE2000 + f1_score для части хранилища миниатюр, выполняется в дочернем процессе.
+    # Миниатюры читаются из отображенного в память файла без копирования
+    thumbnails = lab_store.open_thumbnails(data_path)
     top_similars = {}
-    main_image_data = await fetch_image_data(ctx, main_image_id)
-    if main_image_data is None:
-        ctx.logger.warning(f"Данные изображения не найдены для ID {main_image_id}")
-        return []
+    for image_id, slot in zip(image_ids, slots):
+        im2_lab = thumbnails[slot].astype(np.float32)
+        similarity_lab = deltaE_ciede2000(im1_lab, im2_lab).mean()
+        similarity_hist = cv2.compareHist(im1_hist, ab_histogram(im2_lab), cv2.HISTCMP_INTERSECT)
+        top_similars[int(image_id)] = f1_score(similarity_lab, similarity_hist)
+    return top_similars
+
+async def score_candidates(ctx, candidate_ids, im1_lab, im1_hist):
+    image_ids, slots, data_path = ctx.lab_store.slots(candidate_ids)
+    if not len(slots):
+        return {}
+    chunk_size = math.ceil(len(slots) / ciede_workers())
+    chunks = await asyncio.gather(*(
+        ctx.compute.run_process(score_chunk, data_path, image_ids[i:i + chunk_size], slots[i:i + chunk_size], im1_lab, im1_hist)
+        for i in range(0, len(slots), chunk_size)
+    ))
+    top_similars = {}
+    for chunk in chunks:
+        top_similars.update(chunk)
+    return top_similars
+
+def shortlist_size_default():
+    return int(os.getenv("CIEDE_SHORTLIST", 50))
 
-    im1_lab = bgra_2_lab(main_image_data['file_data'], ctx)
-    if im1_lab is None:
-        ctx.logger.warning(f"Ошибка при обработке изображения для ID {main_image_id}")
+async def get_top_similar_imgs(main_image_id, ctx, top_count=3, shortlist_size=None, exhaustive=False):
+    # Получение топовых похожих изображений по заданному ID основного изображения.
+    # По умолчанию CIEDE2000 считается только для кандидатов, отобранных по гистограммам a/b,
+    # exhaustive=True - полный перебор корпуса
+    main_thumbnail = ctx.lab_store.get(main_image_id)
+    if main_thumbnail is None:
+        # Изображение еще не проиндексировано - внеочередной проход индексации
+        ctx.indexer.request()
+        ctx.logger.warning(f"Данные изображения не найдены для ID {main_image_id}")
         return []
+    im1_lab = main_thumbnail.astype(np.float32)
 
-    im1_hist = histogram_mask(im1_lab, ctx)
+    im1_hist = await ctx.compute.run(histogram_mask, im1_lab, ctx)
     if im1_hist is None:
         ctx.logger.warning(f"Ошибка при вычислении маски гистограммы для изображения ID {main_image_id}")
         return []
 
-    async with ctx.db_handle.acquire() as conn:
-        async with conn.transaction():
-            selected_images = await database.fetch_all_rows_without_target(conn, main_image_id)
-            for row in selected_images:
-
-                image_data = row['file_data']
-                if image_data is None:
-                    ctx.logger.warning(f"Данные изображения не найдены для ID {row['id']}")
-                    continue
-
-                im2_lab = bgra_2_lab(image_data, ctx)
-                if im2_lab is None:
-                    ctx.logger.warning(f"Ошибка при обработке изображения для ID {row['id']}")
-                    continue
-
-                similarity_lab = deltaE_ciede2000(im1_lab, im2_lab).mean()
-                im2_hist = histogram_mask(im2_lab, ctx)
-                if im2_hist is None:
-                    ctx.logger.warning(f"Ошибка при вычислении маски гистограммы для изображения ID {row['id']}")
-                    continue
-
-                similarity_hist = cv2.compareHist(im1_hist, im2_hist, cv2.HISTCMP_INTERSECT)
-                similarity = f1_score(similarity_lab, similarity_hist)
-                top_similars[row['id']] = similarity
+    if exhaustive:
+        candidate_ids = ctx.lab_store.ids()
+        candidate_ids = candidate_ids[candidate_ids != main_image_id]
+    else:
+        candidate_ids = await ctx.compute.run(ctx.ciede_index.shortlist, im1_hist, shortlist_size or shortlist_size_default(), main_image_id)
+    top_similars = await score_candidates(ctx, candidate_ids, im1_lab, im1_hist)
 
     if not top_similars:
         ctx.logger.warning("Похожие изображения не найдены.")
@@ -104,10 +191,23 @@ async def get_top_similar_imgs(main_image_id, ctx, top_count=3):
     top_image_ids = [top_item[0] for top_item in top_similars[:top_count]]
     return top_image_ids
 
-async def ciedge2000(target_image_id, ctx):
+async def recall_report(image_ids, ctx, shortlist_size=None, top_count=3):
+    # Доля результатов полного перебора, найденных двухэтапным поиском (recall@top_count)
+    shortlist_size = shortlist_size or shortlist_size_default()
+    recalls = {}
+    for image_id in image_ids:
+        exact = await get_top_similar_imgs(image_id, ctx, top_count, exhaustive=True)
+        approximate = await get_top_similar_imgs(image_id, ctx, top_count, shortlist_size)
+        if exact and isinstance(exact[0], int):
+            recalls[image_id] = len(set(exact) & set(approximate)) / len(exact)
+    mean_recall = sum(recalls.values()) / len(recalls) if recalls else None
+    ctx.logger.info(f"Recall@{top_count} двухэтапного поиска CIEDE2000 (кандидатов {shortlist_size}): {mean_recall}")
+    return {"shortlist": shortlist_size, "top_count": top_count, "mean_recall": mean_recall, "recall_by_image_id": recalls}
+
+async def ciedge2000(target_image_id, ctx, shortlist_size=None, exhaustive=False):
     # Основная функция для поиска похожих изображений для заданного ID целевого изображения.
     try:
-        similar_images = await get_top_similar_imgs(target_image_id, ctx)
+        similar_images = await get_top_similar_imgs(target_image_id, ctx, shortlist_size=shortlist_size, exhaustive=exhaustive)
         return similar_images
     except Exception as e:
         ctx.logger.error(f"Ошибка в основной функции: {e}")
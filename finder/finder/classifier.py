@@ -1,25 +1,64 @@
-import torch, io, torchvision, os
+import torch, torchvision, os
 from torchvision import transforms
-from PIL import Image
 from finder.utils import database, constants
+from finder import batch_encoder, decode
 
-# Функция для загрузки и предобработки изображения из базы данных
-async def load_image_from_database(ctx, target_image_id):
+def preprocess_image(file_data, reduced=True):
+    # Декодирование и предобработка изображения для классификатора, декодер сразу уменьшает изображение до >= 224
+    image = decode.pil_open(file_data, constants.SIZE_224 if reduced else None).convert('RGB')
+    preprocess = transforms.Compose([
+        transforms.Resize((constants.SIZE_224, constants.SIZE_224)),
+        transforms.ToTensor(),
+        transforms.Normalize(constants.MEAN, constants.STD)
+    ])
+    return preprocess(image)
+
+def classify_batch(ctx, tensors):
+    # Предсказанные метки классов для пакета изображений
+    outputs = ctx.classify_model.get()(torch.stack(tensors))
+    _, predicted = torch.max(outputs, 1)
+    return [constants.CLASSES[predicted_class] for predicted_class in predicted.tolist()]
+
+def classify_tensors(ctx, tensors):
+    # Forward pass для пакета, собранного микро-батчером из одновременных запросов
+    with torch.no_grad():
+        return classify_batch(ctx, tensors)
+
+async def save_classes(ctx, records):
+    if records:
+        async with ctx.db_handle.acquire() as conn:
+            await database.update_predicted_classes(conn, records, ctx.classify_model.version)
+
+async def classify_missing(ctx, image_ids=None):
+    # Классификация изображений без класса текущей версии классификатора (всех или только image_ids),
+    # классы сохраняются в selected_images.predicted_class вместе с версией по пакетам
+    classified = 0
+    rows = database.iterate_selected_images_without_class(ctx.db_handle, ctx.classify_model.version, image_ids)
+    async for labels in batch_encoder.encode_batches(ctx, rows, preprocess_image, lambda tensors: classify_batch(ctx, tensors), name="classifier", rendition=constants.SIZE_224):
+        await save_classes(ctx, labels)
+        classified += len(labels)
+    return classified
+
+async def classify_images(ctx, image_ids=None):
+    # Массовая классификация: классы считаются только для изображений без сохраненного класса.
+    # image_ids=None - все изображения selected_images
+    classified = await classify_missing(ctx, image_ids)
+    ctx.logger.info(f"Классифицировано {classified} изображений")
+    if image_ids is None:
+        return {"classified": classified}
+    async with ctx.db_handle.acquire() as conn:
+        rows = await database.fetch_predicted_classes(conn, image_ids, ctx.classify_model.version)
+    return {"classified": classified, "classes": {row['id']: row['predicted_class'] for row in rows}}
+
+# Функция для загрузки и предобработки изображения из базы данных, rows - строка изображения без данных
+async def load_image_from_database(ctx, rows):
     try:
         ctx.logger.info("Получение изображения из базы данных...")
-        async with ctx.db_handle.acquire() as conn:
-            file_data = await database.fetch_row_selected_image(conn, target_image_id)
-        if file_data:
-            image = Image.open(io.BytesIO(file_data['file_data'])).convert('RGB')
-            preprocess = transforms.Compose([
-                transforms.Resize((constants.SIZE_224, constants.SIZE_224)),
-                transforms.ToTensor(),
-                transforms.Normalize(constants.MEAN, constants.STD)
-            ])
-            image_tensor = preprocess(image)
-            image_tensor = image_tensor.unsqueeze(0)  # Добавление размерности пакета
+        # Предобработанный тензор берется из кэша изображений, если он там есть
+        prepared = await batch_encoder.prepare_batch(ctx, rows, preprocess_image, "classifier", constants.SIZE_224)
+        if prepared:
             ctx.logger.info("Изображение успешно получено и предобработано")
-            return image_tensor
+            return prepared[0][1]
         else:
             ctx.logger.error("Изображение не найдено в базе данных")
             return None
@@ -29,21 +68,20 @@ async def load_image_from_database(ctx, target_image_id):
 
 async def predict_class(target_image_id, ctx):
     try:
-        # Загрузка предобученной модели
-        model = ctx.classify_model
+        # Сохраненный ранее класс и хэш содержимого - одним запросом, без данных изображения.
+        # Класс, сохраненный текущей версией классификатора, возвращается без обращения к модели
+        async with ctx.db_handle.acquire() as conn:
+            rows = await database.fetch_many_by_ids(conn, [target_image_id], with_data=False)
+        if rows and rows[0]['predicted_class'] is not None and rows[0]['predicted_class_version'] == ctx.classify_model.version:
+            return rows[0]['predicted_class']
 
         # Получение изображения из базы данных
-        image_tensor = await load_image_from_database(ctx, target_image_id)
+        image_tensor = await load_image_from_database(ctx, rows)
 
         if image_tensor is not None:
-            # Предсказание класса
-            with torch.no_grad():
-                outputs = model(image_tensor)
-                _, predicted = torch.max(outputs, 1)
-
-            # Получение предсказанного класса
-            predicted_class = predicted.item()
-            predicted_label = constants.CLASSES[predicted_class]
+            # Предсказание класса, одновременные запросы объединяются в один пакет
+            predicted_label = await ctx.classify_batcher.submit(image_tensor)
+            await save_classes(ctx, [(target_image_id, predicted_label)])
 
             ctx.logger.info("Предсказанный класс: %s", predicted_label)
             return predicted_label
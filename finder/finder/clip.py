@@ -1,53 +1,58 @@
-from dotenv import dotenv_values
-import io, torch
-from finder.utils import database
+import torch
+from finder.utils import constants
+from finder import features, decode
 import clip
-from PIL import Image
-
-async def get_images(ctx):
-    try:
-        async with ctx.db_handle.acquire() as conn:
-            async with conn.transaction():
-                result = await database.fetch_all_selected_images_id_data(conn)
-                return result
-    except Exception as e:
-        ctx.logger.error(f"Ошибка при выполнении запроса к базе данных: {e}")
-        raise
-
-async def calculate_similarity(model, image, text):
-    with torch.no_grad():
-        image_features = model.encode_image(image)
-        text_features = model.encode_text(text)
-        similarity = (image_features @ text_features.T).cpu().numpy()
-    return similarity[0][0]
-
-async def text_search(model, preprocess, device, word, ctx, save=5):
-    text = clip.tokenize([word]).to(device)
-    similarities = []
-
-    images = await get_images(ctx)
-
-    for image_id, image_data in images:
-        try:
-            image_stream = io.BytesIO(image_data)
-            image = preprocess(Image.open(image_stream)).unsqueeze(0).to(device)
-            similarity = await calculate_similarity(model, image, text)
-            similarities.append((image_id, similarity))
-        except Exception as e:
-            ctx.logger.error(f"Ошибка при обработке изображения {image_id}: {e}")
 
-    similarities.sort(key=lambda x: x[1], reverse=True)
-
-    return [image_id for image_id, _ in similarities[:save]]
-
-async def clip_text_searcher(query, ctx):
-    model, preprocess, device = ctx.clip_model
-
-    return await text_search(model, preprocess, device, query, ctx)
+def preprocess_image(ctx, file_data, reduced=True):
+    _, preprocess, _ = ctx.clip_model.get()
+    return apply_preprocess(preprocess, file_data, reduced)
+
+def apply_preprocess(preprocess, file_data, reduced=True):
+    # Предобработка CLIP, декодер сразу уменьшает изображение до >= 224
+    with decode.pil_open(file_data, constants.SIZE_224 if reduced else None) as img:
+        return preprocess(img)
+
+def encode_images(ctx, tensors):
+    # Нормированные векторы признаков CLIP для пакета изображений, считаются один раз при индексации
+    model, _, device = ctx.clip_model.get()
+    image_features = model.encode_image(torch.stack(tensors).to(device))
+    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+    return image_features.float().cpu().numpy()
+
+def encode_text(ctx, text):
+    # Нормированный вектор признаков текста, повторные запросы берутся из LRU кэша
+    text_features = ctx.clip_text_cache.get(text)
+    if text_features is not None:
+        return text_features
+
+    model, _, device = ctx.clip_model.get()
+    tokens = clip.tokenize([text]).to(device)
+    with torch.no_grad():
+        text_features = model.encode_text(tokens)
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+    text_features = text_features.squeeze(0).float().cpu().numpy()
+    ctx.clip_text_cache.put(text, text_features)
+    return text_features
+
+async def index_new_images(ctx, current_ids=None):
+    await features.sync_index(ctx, ctx.clip_index, ctx.clip_model.version, lambda file_data: preprocess_image(ctx, file_data), lambda tensors: encode_images(ctx, tensors), rendition=constants.SIZE_224, current_ids=current_ids)
+
+async def reindex(ctx):
+    async with ctx.indexer.lock:
+        indexed = await features.reindex(ctx, ctx.clip_model.version, lambda file_data: preprocess_image(ctx, file_data), lambda tensors: encode_images(ctx, tensors), rendition=constants.SIZE_224)
+        ctx.clip_index.clear()
+        await index_new_images(ctx)
+    return indexed
+
+async def text_search(word, ctx, save=5):
+    # Текст кодируется один раз, весь корпус оценивается одним матричным произведением
+    text_features = await ctx.compute.run(encode_text, ctx, word)
+    image_ids, _ = await ctx.compute.run(ctx.clip_index.search, text_features, save)
+    return [int(image_id) for image_id in image_ids[0]]
 
 async def clip_search(search_text, ctx):
 
-    image_ids = await clip_text_searcher(search_text, ctx)
+    image_ids = await text_search(search_text, ctx)
 
     ctx.logger.info(f"Поиск изображений с IDs: {image_ids}")
 
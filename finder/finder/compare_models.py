@@ -0,0 +1,122 @@
+"""Сравнение вариантов моделей (int8, torchscript) с исходными fp32 на изображениях из базы.
+
+Для каждой модели и варианта выводится время загрузки, задержка forward pass для пакетов
+размера 1 и --batch-size, а также согласие с fp32: совпадение top-1 класса и пересечение top-k
+классов для классификатора, пересечение k ближайших соседей и косинусная близость эмбеддингов
+для photo и clip.
+
+Запуск: poetry run compare_models --limit 200 --k 5
+"""
+import argparse, asyncio, io, os, time
+import numpy as np
+import torch
+from PIL import Image
+from finder import model_loader, photo, classifier
+from finder.utils import database
+
+def image_forward(name, model):
+    # Выход модели для пакета тензоров в виде матрицы numpy
+    if name == "clip":
+        clip_model, _, device = model
+        return lambda batch: clip_model.encode_image(batch.to(device)).float().cpu().numpy()
+    if name == "photo":
+        return lambda batch: model(batch).flatten(1).numpy()
+    return lambda batch: model(batch).numpy()
+
+def preprocess(name, model, file_data):
+    if name == "clip":
+        _, clip_preprocess, _ = model
+        with Image.open(io.BytesIO(file_data)) as img:
+            return clip_preprocess(img)
+    if name == "photo":
+        return photo.preprocess_image(file_data)
+    return classifier.preprocess_image(file_data)
+
+def run_model(forward, tensors, batch_size):
+    outputs = []
+    latencies = []
+    with torch.no_grad():
+        for i in range(0, len(tensors), batch_size):
+            batch = torch.stack(tensors[i:i + batch_size])
+            started = time.perf_counter()
+            outputs.append(forward(batch))
+            latencies.append((time.perf_counter() - started) / len(batch))
+    return np.concatenate(outputs), float(np.mean(latencies)) * 1000
+
+def topk(scores, k):
+    return np.argsort(-scores, axis=1)[:, :k]
+
+def neighbors(embeddings, k):
+    normalized = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    similarities = normalized @ normalized.T
+    np.fill_diagonal(similarities, -np.inf)
+    return topk(similarities, k)
+
+def overlap(first, second):
+    return float(np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(first.tolist(), second.tolist())]))
+
+def agreement(name, reference, outputs, k):
+    if name == "classify":
+        return {
+            "top1": float(np.mean(reference.argmax(axis=1) == outputs.argmax(axis=1))),
+            f"top{k}_overlap": overlap(topk(reference, k), topk(outputs, k)),
+        }
+    cosine = np.sum(reference * outputs, axis=1) / np.maximum(np.linalg.norm(reference, axis=1) * np.linalg.norm(outputs, axis=1), 1e-12)
+    k = min(k, len(reference) - 1)
+    return {
+        "mean_cosine": float(cosine.mean()),
+        f"knn{k}_overlap": overlap(neighbors(reference, k), neighbors(outputs, k)) if k > 0 else None,
+    }
+
+def load_model(name, variant, model_path):
+    started = time.perf_counter()
+    if name == "classify":
+        model = model_loader.load_classify_model(model_path, variant)
+    elif name == "photo":
+        model = model_loader.load_photo_model(variant)
+    else:
+        model = model_loader.load_clip_model(variant)
+    return model, time.perf_counter() - started
+
+async def fetch_sample(limit):
+    pool = await database.connect()
+    try:
+        async with pool.acquire() as conn:
+            # Сначала только id, затем данные первых limit изображений
+            ids = [row['id'] for row in await database.fetch_selected_images_ids(conn)][:limit]
+            rows = {row['id']: row['file_data'] for row in await database.fetch_many_by_ids(conn, ids)}
+    finally:
+        await database.disconnect(pool)
+    return [rows[image_id] for image_id in ids if image_id in rows]
+
+def compare(name, images, args):
+    reference_model, load_time = load_model(name, "fp32", args.model_path)
+    tensors = [preprocess(name, reference_model, file_data) for file_data in images]
+    reference, _ = run_model(image_forward(name, reference_model), tensors, args.batch_size)
+
+    for variant in model_loader.MODEL_VARIANTS[name]:
+        model, load_time = (reference_model, load_time) if variant == "fp32" else load_model(name, variant, args.model_path)
+        forward = image_forward(name, model)
+        run_model(forward, tensors[:1], 1)  # Прогрев
+        _, latency_1 = run_model(forward, tensors, 1)
+        outputs, latency_batch = run_model(forward, tensors, args.batch_size)
+        print(f"{name:9} {variant:12} загрузка {load_time:6.1f} с  "
+              f"{latency_1:7.2f} мс/изобр. (пакет 1)  {latency_batch:7.2f} мс/изобр. (пакет {args.batch_size})  "
+              f"согласие с fp32: {agreement(name, reference, outputs, args.k)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение вариантов моделей finder с fp32")
+    parser.add_argument("--limit", type=int, default=200, help="число изображений из selected_images")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--models", nargs="+", default=["classify", "photo", "clip"], choices=["classify", "photo", "clip"])
+    parser.add_argument("--model-path", default=os.getenv("MODEL_PATH"))
+    args = parser.parse_args()
+
+    images = asyncio.run(fetch_sample(args.limit))
+    print(f"Изображений: {len(images)}, потоков torch: {torch.get_num_threads()}")
+    for name in args.models:
+        compare(name, images, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import io, cv2
+import numpy as np
+from PIL import Image
+
+# Декодирование с уменьшением: кодек сразу выдает изображение в 2, 4 или 8 раз меньше,
+# если меньшая сторона при этом остается не меньше целевого размера.
+# JPEG масштабируется при декодировании (DCT), остальные форматы (PNG после удаления фона)
+# декодируются полностью и быстро уменьшаются в целое число раз перед точным resize
+REDUCED_FLAGS = {
+    cv2.IMREAD_COLOR: {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8},
+    cv2.IMREAD_GRAYSCALE: {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8},
+}
+
+def is_jpeg(file_data):
+    return file_data[:2] == b"\xff\xd8"
+
+def reduction_factor(width, height, target_size, factors=(8, 4, 2)):
+    # Наибольший коэффициент уменьшения, при котором меньшая сторона не меньше target_size
+    for factor in factors:
+        if min(width, height) // factor >= target_size:
+            return factor
+    return 1
+
+def image_size(file_data):
+    # Размер изображения по заголовку, без декодирования пикселей
+    with Image.open(io.BytesIO(file_data)) as img:
+        return img.size
+
+def cv2_decode(file_data, target_size=None, flags=cv2.IMREAD_COLOR):
+    # Аналог cv2.imdecode, меньшая сторона результата не меньше target_size
+    buffer = np.frombuffer(file_data, np.uint8)
+    if target_size is None:
+        return cv2.imdecode(buffer, flags)
+
+    factor = reduction_factor(*image_size(file_data), target_size)
+    if factor == 1:
+        return cv2.imdecode(buffer, flags)
+    # У JPEG нет альфа-канала, поэтому IMREAD_UNCHANGED для него равносилен IMREAD_COLOR
+    reduced_flags = REDUCED_FLAGS.get(cv2.IMREAD_COLOR if flags == cv2.IMREAD_UNCHANGED else flags)
+    if is_jpeg(file_data) and reduced_flags is not None:
+        return cv2.imdecode(buffer, reduced_flags[factor])
+
+    image = cv2.imdecode(buffer, flags)
+    height, width = image.shape[:2]
+    return cv2.resize(image, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+
+def pil_open(file_data, target_size=None):
+    # Аналог Image.open + load, меньшая сторона результата не меньше target_size.
+    # Возвращается загруженное изображение, файл закрывать не нужно
+    img = Image.open(io.BytesIO(file_data))
+    if target_size is not None and img.format == "JPEG":
+        # draft выбирает наименьший масштаб DCT, при котором размер не меньше запрошенного
+        img.draft(img.mode, (target_size, target_size))
+    img.load()
+    if target_size is not None:
+        factor = reduction_factor(*img.size, target_size)
+        if factor > 1 and img.mode in ("L", "LA", "RGB", "RGBA"):
+            img = img.reduce(factor)
+    return img
@@ -0,0 +1,47 @@
+import asyncio, os, functools
+from contextlib import asynccontextmanager
+
+class ComputeExecutor:
+    # Вычисления вне цикла событий: пул потоков для OpenCV и torch (освобождают GIL)
+    # и пул процессов для расчетов на чистом Python и NumPy (CIEDE2000).
+    # Число одновременно обрабатываемых запросов каждого эндпоинта ограничено
+    # (<ЭНДПОИНТ>_CONCURRENCY, по умолчанию COMPUTE_CONCURRENCY), поэтому тяжелые запросы
+    # не занимают все воркеры и легкие продолжают обслуживаться.
+    # Индексация и переиндексация (декодирование пакетов и forward pass) выполняются на отдельном
+    # пуле потоков background (INDEX_WORKERS) и не стоят в одной очереди с запросами поиска
+    def __init__(self, threads, processes, background):
+        self.threads = threads
+        self.processes = processes
+        self.background = background
+        self._limits = {}
+
+    def _limit(self, endpoint):
+        if endpoint not in self._limits:
+            default = os.getenv("COMPUTE_CONCURRENCY", os.cpu_count())
+            self._limits[endpoint] = asyncio.Semaphore(int(os.getenv(f"{endpoint.upper()}_CONCURRENCY", default)))
+        return self._limits[endpoint]
+
+    @asynccontextmanager
+    async def endpoint(self, name):
+        async with self._limit(name):
+            yield
+
+    async def run(self, func, *args, **kwargs):
+        # Выполнение на пуле потоков
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.threads, functools.partial(func, *args, **kwargs))
+
+    async def run_background(self, func, *args, **kwargs):
+        # Выполнение на пуле потоков индексации
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.background, functools.partial(func, *args, **kwargs))
+
+    async def run_process(self, func, *args):
+        # Выполнение на пуле процессов, func и аргументы должны сериализоваться
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.processes, func, *args)
+
+    def shutdown(self):
+        self.threads.shutdown()
+        self.background.shutdown()
+        self.processes.shutdown()
@@ -0,0 +1,67 @@
+import numpy as np
+from finder.utils import database
+from finder import batch_encoder
+
+def vector_to_bytes(vector):
+    # Сериализация вектора признаков для хранения в BYTEA
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+def bytes_to_vector(data):
+    return np.frombuffer(data, dtype=np.float32)
+
+async def index_missing(ctx, model_version, preprocess, forward, serialize=vector_to_bytes, rendition=None):
+    # Вычисление признаков только для тех изображений, у которых их еще нет.
+    # Изображения читаются страницами и сохраняются по пакетам, память не растет с размером корпуса.
+    # rendition - размер уменьшенной копии изображения, достаточный для preprocess (None - оригинал)
+    indexed = 0
+    rows = database.iterate_selected_images_without_features(ctx.db_handle, model_version)
+    async for encoded in batch_encoder.encode_batches(ctx, rows, preprocess, forward, name=model_version, rendition=rendition):
+        records = [(image_id, serialize(vector)) for image_id, vector in encoded]
+        async with ctx.db_handle.acquire() as conn:
+            await database.upsert_features(conn, model_version, records)
+        indexed += len(records)
+
+    if indexed:
+        ctx.logger.info(f"Проиндексировано {indexed} изображений, версия признаков {model_version}")
+    return indexed
+
+async def load_features(ctx, model_version, image_ids=None, deserialize=bytes_to_vector):
+    # Загрузка сохраненных признаков: массив id и список векторов
+    async with ctx.db_handle.acquire() as conn:
+        rows = await database.fetch_features(conn, model_version, image_ids)
+    ids = np.array([row['selected_image_id'] for row in rows], dtype=np.int64)
+    return ids, [deserialize(row['data']) for row in rows]
+
+async def reindex(ctx, model_version, preprocess, forward, serialize=vector_to_bytes, rendition=None):
+    # Полный пересчет признаков корпуса для версии модели
+    ctx.logger.info(f"Переиндексация признаков {model_version} - начало")
+    async with ctx.db_handle.acquire() as conn:
+        await database.delete_features(conn, model_version)
+    indexed = await index_missing(ctx, model_version, preprocess, forward, serialize, rendition)
+    ctx.logger.info(f"Переиндексация признаков {model_version} - завершено")
+    return indexed
+
+async def current_image_ids(ctx):
+    async with ctx.db_handle.acquire() as conn:
+        rows = await database.fetch_selected_images_ids(conn)
+    return np.array([row['id'] for row in rows], dtype=np.int64)
+
+async def sync_index(ctx, index, model_version, preprocess, forward, serialize=vector_to_bytes, deserialize=bytes_to_vector, rendition=None, current_ids=None):
+    # Приведение индекса в памяти к текущему содержимому selected_images без полной перестройки:
+    # новые изображения индексируются и добавляются, удаленные - исключаются из индекса.
+    # current_ids - id строк selected_images, если они уже прочитаны
+    await index_missing(ctx, model_version, preprocess, forward, serialize, rendition)
+    if current_ids is None:
+        current_ids = await current_image_ids(ctx)
+    index_ids = index.ids()
+
+    removed_ids = np.setdiff1d(index_ids, current_ids)
+    await ctx.compute.run_background(index.remove, removed_ids)
+    ctx.image_cache.invalidate(removed_ids)
+
+    added_ids = np.setdiff1d(current_ids, index_ids)
+    if added_ids.size:
+        ids, vectors = await load_features(ctx, model_version, added_ids.tolist(), deserialize)
+        await ctx.compute.run_background(index.add, ids, vectors)
+    if removed_ids.size or added_ids.size:
+        ctx.logger.info(f"Индекс {model_version}: добавлено {added_ids.size}, удалено {removed_ids.size}, всего {len(index)}")
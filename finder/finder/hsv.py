@@ -1,58 +1,126 @@
-import cv2
-from finder.utils import database
+import cv2, threading
+from finder.utils import constants
+from finder import features
 import numpy as np
+from scipy import sparse
 from typing import List, Tuple
 
-async def fetch_image_data(ctx, image_id):
-    ctx.logger.info(f"Поиск изображения по ID: {image_id}")
-    async with ctx.db_handle.acquire() as conn:
-        row = await database.fetch_row_selected_image(conn, image_id)
-    if row:
-        ctx.logger.info(f"Изображение успешно найдено по ID: {image_id}")
-        return row['file_data']
-    else:
-        ctx.logger.warning(f"Изображение не найдено по ID: {image_id}")
-        return None
+HIST_SIZE = [32, 32, 32]
+HIST_BINS = int(np.prod(HIST_SIZE))
 
 def calculate_hist_hsv(image_data, ctx):
     ctx.logger.info("Считаем HSV гистограмму")
     image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
     hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    hist_hsv = cv2.calcHist([hsv_image], [0, 1, 2], None, [32, 32, 32], [0, 180, 0, 256, 0, 256])
+    hist_hsv = cv2.calcHist([hsv_image], [0, 1, 2], None, HIST_SIZE, [0, 180, 0, 256, 0, 256])
     hist_hsv = cv2.normalize(hist_hsv, hist_hsv).flatten()
     ctx.logger.info("HSV гистограмма посчитана")
     return hist_hsv
 
-async def find_similar_images_db(target_image_id, ctx, top_n=3) -> List[Tuple[int, float]]:
-    ctx.logger.info(f"Поиск похожих по HSV для изображения с ID: {target_image_id}")
-    target_image_data = await fetch_image_data(ctx, target_image_id)
-    if not target_image_data:
-        raise ValueError(f"Изображение не найдено по ID: {target_image_id}")
+def hist_to_bytes(hist):
+    # Разреженное хранение гистограммы: индексы ненулевых бинов (uint16) и их значения (float32).
+    # У изображений с удаленным фоном заполнена лишь малая часть из 32768 бинов
+    indices = np.flatnonzero(hist).astype(np.uint16)
+    values = np.asarray(hist, dtype=np.float32)[indices]
+    return indices.tobytes() + values.tobytes()
+
+def bytes_to_hist(data):
+    nnz = len(data) // 6
+    indices = np.frombuffer(data, dtype=np.uint16, count=nnz)
+    values = np.frombuffer(data, dtype=np.float32, count=nnz, offset=2 * nnz)
+    return indices, values
+
+class HistogramIndex:
+    # Гистограммы корпуса одной разреженной матрицей: хранятся корни из значений бинов и суммы строк,
+    # что позволяет посчитать расстояние Бхаттачарьи до всего корпуса одним произведением
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._view = (np.empty(0, dtype=np.int64), sparse.csr_matrix((0, HIST_BINS)), np.empty(0))
+
+    def __len__(self):
+        return len(self._view[0])
+
+    def ids(self):
+        return self._view[0]
+
+    def add(self, ids, hists):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if ids.size == 0:
+            return
+        indptr = np.zeros(ids.size + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(indices) for indices, _ in hists])
+        indices = np.concatenate([indices for indices, _ in hists]).astype(np.int32)
+        values = np.concatenate([values for _, values in hists]).astype(np.float64)
+        roots = sparse.csr_matrix((np.sqrt(values), indices, indptr), shape=(ids.size, HIST_BINS))
+        sums = np.array([values.sum(dtype=np.float64) for _, values in hists])
 
-    target_hist = calculate_hist_hsv(target_image_data, ctx)
+        with self._lock:
+            current_ids, current_roots, current_sums = self._view
+            keep = ~np.isin(current_ids, ids)
+            self._view = (
+                np.concatenate([current_ids[keep], ids]),
+                sparse.vstack([current_roots[keep], roots], format="csr"),
+                np.concatenate([current_sums[keep], sums]),
+            )
 
-    similarities = []
+    def remove(self, ids):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if ids.size == 0:
+            return
+        with self._lock:
+            current_ids, current_roots, current_sums = self._view
+            keep = ~np.isin(current_ids, ids)
+            if not keep.all():
+                self._view = (current_ids[keep], current_roots[keep], current_sums[keep])
 
-    async with ctx.db_handle.acquire() as conn:
-        async with conn.transaction():
-            selected_images = await database.fetch_all_rows_without_target(conn, target_image_id)
-            for row in selected_images:
-                image_id = row['id']
-                image_data = row['file_data']
-                hist = calculate_hist_hsv(image_data, ctx)
-                similarity = cv2.compareHist(target_hist, hist, cv2.HISTCMP_BHATTACHARYYA)
-                similarities.append((image_id, similarity))
+    def clear(self):
+        with self._lock:
+            self._view = (np.empty(0, dtype=np.int64), sparse.csr_matrix((0, HIST_BINS)), np.empty(0))
 
-    similarities.sort(key=lambda x: x[1])
+    def search(self, target_image_id, top_n):
+        # Расстояние Бхаттачарьи в формулировке cv2.HISTCMP_BHATTACHARYYA:
+        # sqrt(max(1 - sum(sqrt(h1 * h2)) / sqrt(sum(h1) * sum(h2)), 0))
+        ids, roots, sums = self._view
+        positions = np.flatnonzero(ids == target_image_id)
+        if positions.size == 0:
+            raise ValueError(f"Изображение не найдено по ID: {target_image_id}")
+        position = positions[0]
 
-    most_similar_images = similarities[:top_n]
+        scores = np.asarray((roots @ roots[position].T).todense()).ravel()
+        denominator = sums * sums[position]
+        safe_denominator = np.where(np.abs(denominator) > np.finfo(np.float32).eps, denominator, 1.0)
+        scale = np.where(np.abs(denominator) > np.finfo(np.float32).eps, 1.0 / np.sqrt(safe_denominator), 1.0)
+        distances = np.sqrt(np.maximum(1.0 - scores * scale, 0.0))
+
+        candidates = np.delete(np.arange(len(ids)), position)
+        top_n = min(top_n, candidates.size)
+        if top_n <= 0:
+            return []
+        top = candidates[np.argpartition(distances[candidates], top_n - 1)[:top_n]]
+        top = top[np.argsort(distances[top], kind="stable")]
+        return [(int(ids[i]), float(distances[i])) for i in top]
+
+async def index_new_images(ctx, current_ids=None):
+    # Гистограммы считаются один раз для новых строк selected_images и хранятся в image_features
+    await features.sync_index(
+        ctx, ctx.hsv_index, constants.HSV_FEATURE_VERSION,
+        lambda image_data: calculate_hist_hsv(image_data, ctx), lambda hists: hists,
+        hist_to_bytes, bytes_to_hist, current_ids=current_ids,
+    )
+
+async def find_similar_images_db(target_image_id, ctx, top_n=3) -> List[Tuple[int, float]]:
+    ctx.logger.info(f"Поиск похожих по HSV для изображения с ID: {target_image_id}")
+    try:
+        most_similar_images = await ctx.compute.run(ctx.hsv_index.search, target_image_id, top_n)
+    except ValueError:
+        # Изображение еще не проиндексировано - внеочередной проход индексации
+        ctx.indexer.request()
+        raise
     ctx.logger.info(f"Найдено {len(most_similar_images)} похожие изобр-я")
     return most_similar_images
 
-async def hsv(target_image_id, ctx):
+async def hsv(target_image_id, ctx, top_n=3):
     ctx.logger.info(f"Старт поиска для изображения с ID: {target_image_id}")
 
-    similar_images_db = await find_similar_images_db(target_image_id, ctx)
+    similar_images_db = await find_similar_images_db(target_image_id, ctx, top_n)
     return similar_images_db
-
-
@@ -0,0 +1,98 @@
+import sys, threading
+from collections import OrderedDict
+import numpy as np
+import torch
+
+def size_of(value):
+    # Оценка занимаемой памяти в байтах для массивов, тензоров, байтов и их кортежей
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(size_of(item) for item in value)
+    return sys.getsizeof(value)
+
+class ImageCache:
+    # Общий для всех алгоритмов finder кэш изображений с бюджетом памяти и LRU вытеснением.
+    # Ключ - (id изображения, хэш содержимого, вид): вид "file_data" - исходные байты из базы,
+    # остальные виды - результат предобработки конкретного алгоритма (миниатюра, тензор, гистограмма).
+    # Хэш содержимого в ключе гарантирует, что после изменения строки старые данные не будут использованы
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._ids = {}
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, image_id, file_hash, kind):
+        key = (image_id, file_hash, kind)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def put(self, image_id, file_hash, kind, value):
+        if file_hash is None:
+            return
+        if isinstance(value, memoryview):
+            # Данные из хранилища файлов (memoryview над mmap) копируются: иначе каждая запись кэша
+            # держала бы открытым файл изображения
+            value = value.tobytes()
+        size = size_of(value)
+        if size > self.max_bytes:
+            return
+        key = (image_id, file_hash, kind)
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (value, size)
+            self._ids.setdefault(image_id, set()).add(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._data)))
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[1]
+        keys = self._ids.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._ids[key[0]]
+
+    def invalidate(self, image_ids):
+        # Удаление всех видов данных для изображений, удаленных или измененных в selected_images
+        with self._lock:
+            for image_id in image_ids:
+                for key in list(self._ids.get(int(image_id), ())):
+                    self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._ids.clear()
+            self.size = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "size": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
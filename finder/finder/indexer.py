@@ -0,0 +1,77 @@
+import asyncio, time
+import numpy as np
+from finder.utils import database
+from finder import hsv, ciedge2000, photo, clip
+
+# Индексы finder, которые поддерживаются в соответствии с selected_images
+INDEXES = {
+    "hsv": hsv.index_new_images,
+    "ciedge2000": ciedge2000.index_new_images,
+    "photo": photo.index_new_images,
+    "clip": clip.index_new_images,
+}
+
+class Indexer:
+    # Индексация новых изображений вне запросов поиска: при запуске, раз в interval секунд и по запросу
+    # (POST /index после rem_bg/rem_dup). Одновременные запросы синхронизации ждут один общий проход,
+    # поэтому признаки каждого изображения считаются один раз. Запросы поиска только читают индексы
+    def __init__(self, ctx, interval):
+        self.ctx = ctx
+        self.interval = interval
+        # Полная переиндексация (photo/reindex, clip/reindex) берет ту же блокировку
+        self.lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._sync_task = None
+        self._loop_task = None
+        self.synced_at = None
+
+    def start(self):
+        self._loop_task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+
+    def request(self):
+        # Внеочередной проход без ожидания результата, например если в индексе нет изображения запроса
+        self._wakeup.set()
+
+    async def sync(self):
+        # Проход синхронизации; если он уже идет, ожидается текущий
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.ensure_future(self._sync())
+        return await asyncio.shield(self._sync_task)
+
+    async def _sync(self):
+        async with self.lock:
+            started = time.perf_counter()
+            # Список id читается один раз на проход для всех индексов
+            async with self.ctx.db_handle.acquire() as conn:
+                rows = await database.fetch_selected_images_ids(conn)
+            current_ids = np.array([row['id'] for row in rows], dtype=np.int64)
+            results = {}
+            for name, index_new_images in INDEXES.items():
+                try:
+                    await index_new_images(self.ctx, current_ids)
+                    results[name] = "ok"
+                except Exception as e:
+                    self.ctx.logger.error(f"Ошибка индексации {name}: {e}")
+                    results[name] = str(e)
+            self.synced_at = time.time()
+            self.ctx.logger.info(f"Синхронизация индексов за {time.perf_counter() - started:.2f} с: {results}")
+            return {"images": int(current_ids.size), "indexes": results}
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.ctx.logger.error(f"Ошибка синхронизации индексов: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
@@ -0,0 +1,138 @@
+import threading
+import numpy as np
+
+METRICS = ("cosine", "euclidean")
+
+class VectorIndex:
+    # Точный kNN индекс в памяти: L2-нормированная матрица float32, нормы исходных векторов и массив id.
+    # Писатель дописывает строки в свободную часть буфера и публикует новый снимок одной операцией присваивания,
+    # поэтому читатели работают со своим снимком без блокировок. Снимок также содержит отсортированные id
+    # и их позиции для поиска векторов по id через np.searchsorted.
+
+    def __init__(self, metric="cosine", capacity=1024):
+        if metric not in METRICS:
+            raise ValueError(f"Неизвестная метрика {metric}, допустимые значения: {METRICS}")
+        self.metric = metric
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self._dim = None
+        self._ids = None
+        self._matrix = None
+        self._norms = None
+        self._view = self._empty_view()
+
+    @staticmethod
+    def _empty_view():
+        empty_ids = np.empty(0, dtype=np.int64)
+        return empty_ids, np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.float32), empty_ids, empty_ids
+
+    def __len__(self):
+        return len(self._view[0])
+
+    def ids(self):
+        return self._view[0]
+
+    def _allocate(self, capacity, dim):
+        ids = np.empty(capacity, dtype=np.int64)
+        matrix = np.empty((capacity, dim), dtype=np.float32)
+        norms = np.empty(capacity, dtype=np.float32)
+        return ids, matrix, norms
+
+    def _publish(self, size):
+        ids = self._ids[:size]
+        order = np.argsort(ids, kind="stable")
+        self._view = (ids, self._matrix[:size], self._norms[:size], ids[order], order)
+
+    def _rebuild(self, ids, matrix, norms):
+        # Копирование в новый буфер: старые массивы остаются неизменными для текущих читателей
+        size = len(ids)
+        capacity = max(self._capacity, 2 * size)
+        self._ids, self._matrix, self._norms = self._allocate(capacity, self._dim)
+        self._ids[:size] = ids
+        self._matrix[:size] = matrix
+        self._norms[:size] = norms
+        self._publish(size)
+
+    def add(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if ids.size == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(ids.size, -1)
+        norms = np.linalg.norm(vectors, axis=1).astype(np.float32)
+        normalized = vectors / np.maximum(norms, np.finfo(np.float32).eps)[:, None]
+
+        with self._lock:
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                self._ids, self._matrix, self._norms = self._allocate(max(self._capacity, ids.size), self._dim)
+            elif vectors.shape[1] != self._dim:
+                raise ValueError(f"Размерность векторов {vectors.shape[1]} не совпадает с размерностью индекса {self._dim}")
+
+            current_ids, current_matrix, current_norms = self._view[:3]
+            replaced = np.isin(current_ids, ids)
+            if replaced.any():
+                # Повторно добавленные id заменяются новыми векторами
+                keep = ~replaced
+                self._rebuild(current_ids[keep], current_matrix[keep], current_norms[keep])
+
+            size = len(self._view[0])
+            if size + ids.size > len(self._ids):
+                current_ids, current_matrix, current_norms = self._view[:3]
+                self._capacity = 2 * (size + ids.size)
+                self._rebuild(current_ids, current_matrix, current_norms)
+
+            self._ids[size:size + ids.size] = ids
+            self._matrix[size:size + ids.size] = normalized
+            self._norms[size:size + ids.size] = norms
+            self._publish(size + ids.size)
+
+    def remove(self, ids):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if ids.size == 0:
+            return
+        with self._lock:
+            current_ids, current_matrix, current_norms = self._view[:3]
+            keep = ~np.isin(current_ids, ids)
+            if not keep.all():
+                self._rebuild(current_ids[keep], current_matrix[keep], current_norms[keep])
+
+    def clear(self):
+        with self._lock:
+            self._dim = None
+            self._ids = self._matrix = self._norms = None
+            self._view = self._empty_view()
+
+    def vectors(self, ids):
+        # Исходные (ненормированные) векторы для заданных id, в порядке запроса
+        _, matrix, norms, sorted_ids, order = self._view
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        found = np.minimum(np.searchsorted(sorted_ids, ids), max(len(sorted_ids) - 1, 0))
+        present = sorted_ids[found] == ids if len(sorted_ids) else np.zeros(ids.size, dtype=bool)
+        if not present.all():
+            raise KeyError(f"Векторы не найдены в индексе для id {ids[~present].tolist()}")
+        rows = order[found]
+        return matrix[rows] * norms[rows][:, None]
+
+    def search(self, queries, k):
+        # Поиск k ближайших соседей для пакета запросов: одно матричное произведение и argpartition.
+        # Возвращает матрицы id и расстояний размера (число запросов, k)
+        index_ids, matrix, norms = self._view[:3]
+        queries = np.asarray(queries, dtype=np.float32)
+        queries = queries.reshape(1, -1) if queries.ndim == 1 else queries
+        k = min(k, len(index_ids))
+        if k <= 0:
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+
+        query_norms = np.linalg.norm(queries, axis=1)
+        similarities = (queries / np.maximum(query_norms, np.finfo(np.float32).eps)[:, None]) @ matrix.T
+        if self.metric == "cosine":
+            distances = 1.0 - similarities
+        else:
+            squared = query_norms[:, None] ** 2 + norms[None, :] ** 2 - 2.0 * similarities * query_norms[:, None] * norms[None, :]
+            distances = np.sqrt(np.maximum(squared, 0.0))
+
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        top_distances = np.take_along_axis(distances, top, axis=1)
+        order = np.argsort(top_distances, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        return index_ids[top], np.take_along_axis(top_distances, order, axis=1)
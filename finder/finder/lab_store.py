@@ -0,0 +1,160 @@
+import os, threading
+import numpy as np
+from finder.utils import constants
+
+THUMBNAIL_SHAPE = (constants.SIZE_256, constants.SIZE_256, 3)
+THUMBNAIL_BYTES = int(np.prod(THUMBNAIL_SHAPE))
+# Версия миниатюр в именах файлов: при изменении способа их построения хранилище заполняется заново
+STORE_VERSION = "v2"
+
+def open_thumbnails(path):
+    # Отображение файла миниатюр в память только для чтения (используется и в дочерних процессах)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.empty((0,) + THUMBNAIL_SHAPE, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r').reshape((-1,) + THUMBNAIL_SHAPE)
+
+class LabThumbnailStore:
+    # Постоянное хранилище миниатюр 256x256 в пространстве Lab (uint8) в файле, отображенном в память.
+    # Слот миниатюры определяется массивом ids (id изображения для каждого слота, -1 - слот удален).
+    # Слоты только дописываются: удаленные слоты не переиспользуются, поэтому читатели в других процессах
+    # никогда не увидят в слоте данные другого изображения. Когда доля удаленных слотов превышает
+    # LAB_STORE_COMPACT_RATIO, живые слоты переписываются в файл следующего поколения, и новый снимок
+    # публикуется вместе с путем к нему. Файлы предыдущего поколения удаляются при следующем сжатии:
+    # читатель мог получить путь к ним незадолго до переключения
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compact_ratio = float(os.getenv("LAB_STORE_COMPACT_RATIO", 0.3))
+        self._lock = threading.Lock()
+        self.generation = self._latest_generation()
+        # Файлы других версий хранилища и незавершенных сжатий не используются
+        self._remove_files([self.generation])
+        slot_ids = np.load(self._ids_path(self.generation)) if os.path.exists(self._ids_path(self.generation)) else np.empty(0, dtype=np.int64)
+        data_path = self._data_path(self.generation)
+        if os.path.exists(data_path) and os.path.getsize(data_path) % THUMBNAIL_BYTES:
+            # Недописанная при аварийной остановке миниатюра отбрасывается
+            with open(data_path, "r+b") as f:
+                f.truncate(os.path.getsize(data_path) // THUMBNAIL_BYTES * THUMBNAIL_BYTES)
+        # Слоты, записанные в файл данных после последнего сохранения ids, считаются удаленными
+        data_slots = len(open_thumbnails(data_path))
+        slot_ids = slot_ids[:data_slots]
+        self._slot_ids = np.concatenate([slot_ids, np.full(data_slots - len(slot_ids), -1, dtype=np.int64)])
+        self._view = self._build_view()
+
+    def _name(self, generation):
+        name = f"lab_thumbnails_{STORE_VERSION}"
+        return os.path.join(self.directory, name if generation == 0 else f"{name}.{generation}")
+
+    def _data_path(self, generation):
+        return self._name(generation) + ".u8"
+
+    def _ids_path(self, generation):
+        return self._name(generation) + "_ids.npy"
+
+    def _latest_generation(self):
+        # Поколение действительно, если его ids сохранены: при сжатии они пишутся после файла данных
+        prefix = os.path.basename(self._name(0))
+        generations = [0]
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix + ".") and name.endswith("_ids.npy"):
+                generation = name[len(prefix) + 1:-len("_ids.npy")]
+                if generation.isdigit():
+                    generations.append(int(generation))
+        return max(generations)
+
+    def _remove_files(self, generations):
+        # Удаление файлов хранилища, кроме файлов поколений generations текущей версии
+        kept = set()
+        for generation in generations:
+            kept |= {os.path.basename(self._data_path(generation)), os.path.basename(self._ids_path(generation))}
+        for name in os.listdir(self.directory):
+            if name.startswith("lab_thumbnails_") and name not in kept:
+                os.unlink(os.path.join(self.directory, name))
+
+    def _build_view(self):
+        positions = np.flatnonzero(self._slot_ids >= 0)
+        data_path = self._data_path(self.generation)
+        return self._slot_ids[positions], positions, open_thumbnails(data_path), data_path
+
+    def _save_ids(self):
+        ids_path = self._ids_path(self.generation)
+        tmp_path = ids_path + ".tmp.npy"
+        np.save(tmp_path, self._slot_ids)
+        os.replace(tmp_path, ids_path)
+
+    def _compact(self):
+        # Вызывается под блокировкой писателя, пока читатели используют текущий снимок
+        dead = int(np.count_nonzero(self._slot_ids < 0))
+        if not dead or dead <= self.compact_ratio * len(self._slot_ids):
+            return
+        live_ids, positions, thumbnails, _ = self._view
+        generation = self.generation + 1
+        with open(self._data_path(generation), "wb") as f:
+            for start in range(0, len(positions), 256):
+                f.write(np.ascontiguousarray(thumbnails[positions[start:start + 256]]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        previous = self.generation
+        self.generation = generation
+        self._slot_ids = live_ids.copy()
+        self._save_ids()
+        self._view = self._build_view()
+        self._remove_files([previous, generation])
+
+    def __len__(self):
+        return len(self._view[0])
+
+    def ids(self):
+        return self._view[0]
+
+    def add(self, ids, thumbnails):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if ids.size == 0:
+            return
+        data = np.ascontiguousarray(np.asarray(thumbnails, dtype=np.uint8).reshape((ids.size,) + THUMBNAIL_SHAPE))
+        with self._lock:
+            replaced = np.isin(self._slot_ids, ids)
+            self._slot_ids = self._slot_ids.copy()
+            self._slot_ids[replaced] = -1
+            with open(self._data_path(self.generation), "ab") as f:
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._slot_ids = np.concatenate([self._slot_ids, ids])
+            self._save_ids()
+            self._view = self._build_view()
+            self._compact()
+
+    def remove(self, ids):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if ids.size == 0:
+            return
+        with self._lock:
+            removed = np.isin(self._slot_ids, ids)
+            if removed.any():
+                self._slot_ids = self._slot_ids.copy()
+                self._slot_ids[removed] = -1
+                self._save_ids()
+                self._view = self._build_view()
+                self._compact()
+
+    def slots(self, ids):
+        # Номера слотов для id изображений и путь к файлу, к которому они относятся (из одного снимка);
+        # id без миниатюры пропускаются
+        store_ids, positions, _, data_path = self._view
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if not len(store_ids):
+            return ids[:0], positions[:0], data_path
+        order = np.argsort(store_ids)
+        sorted_ids = store_ids[order]
+        found = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        mask = sorted_ids[found] == ids
+        return ids[mask], positions[order[found[mask]]], data_path
+
+    def get(self, image_id):
+        # Миниатюра без копирования (представление над отображенным файлом) или None
+        store_ids, positions, thumbnails, _ = self._view
+        slot = positions[store_ids == image_id]
+        if not len(slot):
+            return None
+        return thumbnails[slot[0]]
@@ -1,8 +1,9 @@
-import uvicorn, os
+import uvicorn, os, asyncio
 from pydantic import BaseModel
-from fastapi import Request, FastAPI
-from finder.utils.models import ImageIdParams, ClipParams, PhotoFinderParams
-from finder import hsv, ciedge2000, photo, clip, classifier, model_loader
+from fastapi import Request, FastAPI, status
+from fastapi.responses import JSONResponse
+from finder.utils.models import ImageIdParams, ClassifyBulkParams, ClipParams, PhotoFinderParams, HsvParams, CiedeParams, CiedeRecallParams
+from finder import hsv, ciedge2000, photo, clip, classifier, model_loader, knn_index, cache, batch_encoder, lab_store, executor, micro_batcher, image_cache, indexer
 from finder.utils.utils import Context
 from finder.utils import database
 
@@ -14,36 +15,109 @@ ctx = Context()
 async def startup_event():
   """Вызывается при запуске приложения."""
   ctx.db_handle = await database.connect()
+  await database.migrate(ctx.db_handle)
   ctx.set_logger_handler(os.getenv("FINDER_LOG"))
-  ctx.classify_model = model_loader.load_classify_model(os.getenv("MODEL_PATH"))
-  ctx.photo_model = model_loader.load_photo_model()
-  ctx.clip_model = model_loader.load_clip_model()
+  ctx.logger.info(f"Потоков torch: {batch_encoder.configure_threads()}")
+  ctx.compute = executor.ComputeExecutor(batch_encoder.create_pool(), ciedge2000.create_pool(), batch_encoder.create_background_pool())
+  ctx.image_cache = image_cache.ImageCache(int(os.getenv("IMAGE_CACHE_MB", 512)) * 1024 * 1024)
+  async with ctx.db_handle.acquire() as conn:
+    await database.backfill_selected_images_hashes(conn)
+  ctx.hsv_index = hsv.HistogramIndex()
+  ctx.ciede_index = ciedge2000.AbHistogramIndex()
+  ctx.lab_store = lab_store.LabThumbnailStore(os.getenv("LAB_STORE_DIR", "lab_store"))
+  # Модели загружаются при первом обращении или заранее в фоне (MODEL_PRELOAD), запуск не ждет загрузки
+  ctx.models = model_loader.create_models(os.getenv("MODEL_PATH"))
+  ctx.classify_model, ctx.photo_model, ctx.clip_model = ctx.models["classify"], ctx.models["photo"], ctx.models["clip"]
+  ctx.classify_batcher = micro_batcher.MicroBatcher(lambda tensors: classifier.classify_tensors(ctx, tensors), ctx.compute.run)
+  ctx.photo_index = knn_index.VectorIndex(os.getenv("PHOTO_METRIC", "cosine"))
+  ctx.clip_index = knn_index.VectorIndex("cosine")
+  ctx.clip_text_cache = cache.LRUCache(int(os.getenv("CLIP_TEXT_CACHE_SIZE", 1024)))
+  ctx.preload_task = asyncio.create_task(preload_models()) if os.getenv("MODEL_PRELOAD", "1") == "1" else None
+  # Новые изображения индексируются в фоне, запросы поиска читают готовые индексы
+  ctx.indexer = indexer.Indexer(ctx, float(os.getenv("INDEX_INTERVAL", 60)))
+  ctx.indexer.start()
+
+async def preload_models():
+  # Фоновая загрузка и прогрев моделей по очереди
+  for name, model in ctx.models.items():
+    try:
+      await ctx.compute.run(model.get)
+      ctx.logger.info(f"Модель {name} ({model.variant}) загружена за {model.load_time:.1f} с")
+    except Exception as e:
+      ctx.logger.error(f"Не удалось загрузить модель {name}: {e}")
 
 @app.on_event("shutdown")
 async def shutdown_event():
+  if ctx.preload_task is not None:
+    ctx.preload_task.cancel()
+  await ctx.indexer.close()
   await database.disconnect(ctx.db_handle)
+  await ctx.classify_batcher.close()
+  ctx.compute.shutdown()
+
+@app.get("/ready")
+async def ready():
+    """Готовность сервиса: все модели загружены и прогреты"""
+    models = {name: model.state() for name, model in ctx.models.items()}
+    is_ready = all(model.ready for model in ctx.models.values())
+    return JSONResponse({"ready": is_ready, "models": models}, status_code=status.HTTP_200_OK if is_ready else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+@app.get("/image_cache")
+async def image_cache_stats():
+    """Заполнение кэша изображений и доля попаданий"""
+    return ctx.image_cache.stats()
+
+@app.post("/index")
+async def index():
+    """Индексация новых и удаление исчезнувших изображений во всех индексах, ответ - после завершения прохода"""
+    return await ctx.indexer.sync()
 
 @app.post("/hsv")
-async def start(request: ImageIdParams):
-    similar_images = await hsv.hsv(request.image_id, ctx)
+async def start(request: HsvParams):
+    async with ctx.compute.endpoint("hsv"):
+        similar_images = await hsv.hsv(request.image_id, ctx, request.top_n)
     similar_image_ids = [image[0] for image in similar_images]
     return {"similar_image_by_hsv_ids": similar_image_ids}
 
 @app.post("/ciedge2000")
-async def start(request: ImageIdParams):
-    return {"similar_image_by_ciedge2000_ids": await ciedge2000.ciedge2000(request.image_id, ctx)}
+async def start(request: CiedeParams):
+    async with ctx.compute.endpoint("ciedge2000"):
+        return {"similar_image_by_ciedge2000_ids": await ciedge2000.ciedge2000(request.image_id, ctx, request.shortlist, request.exhaustive)}
+
+@app.post("/ciedge2000/recall")
+async def ciedge2000_recall(request: CiedeRecallParams):
+    async with ctx.compute.endpoint("ciedge2000"):
+        return await ciedge2000.recall_report(request.image_ids, ctx, request.shortlist)
 
 @app.post("/photo")
 async def start(request: PhotoFinderParams):
-    return {"similar_image_by_promt_ids": await photo.find_by_photo(request.image_id, ctx, request.n_neighbors)}
+    async with ctx.compute.endpoint("photo"):
+        return {"similar_image_by_promt_ids": await photo.find_by_photo(request.image_id, ctx, request.n_neighbors)}
+
+@app.post("/photo/reindex")
+async def photo_reindex():
+    async with ctx.compute.endpoint("reindex"):
+        return {"indexed_images": await photo.reindex(ctx)}
 
 @app.post("/clip")
 async def start(request: ClipParams):
-    return {"images_ids_by_clip": await clip.clip_search(request.search_text, ctx)}
+    async with ctx.compute.endpoint("clip"):
+        return {"images_ids_by_clip": await clip.clip_search(request.search_text, ctx)}
+
+@app.post("/clip/reindex")
+async def clip_reindex():
+    async with ctx.compute.endpoint("reindex"):
+        return {"indexed_images": await clip.reindex(ctx)}
 
 @app.post("/classify")
 async def classify(request: ImageIdParams):
-    return {"image_class:": await classifier.predict_class(request.image_id, ctx)}
+    async with ctx.compute.endpoint("classify"):
+        return {"image_class:": await classifier.predict_class(request.image_id, ctx)}
+
+@app.post("/classify/bulk")
+async def classify_bulk(request: ClassifyBulkParams):
+    async with ctx.compute.endpoint("reindex"):
+        return await classifier.classify_images(ctx, None if request.all_images else request.image_ids or [])
 
 def loader():
     """Launched with `poetry run start`"""
@@ -0,0 +1,94 @@
+"""Измерение эффекта декодирования с уменьшением (finder.decode) на изображениях из базы.
+
+Для каждого пути предобработки выводится среднее время полного и уменьшенного декодирования
+с предобработкой, а также изменение результатов: средний CIEDE2000 между миниатюрами Lab
+и пересечение top-k по гистограммам a/b для ciedge2000, совпадение классов для классификатора,
+косинусная близость эмбеддингов и пересечение k ближайших соседей для photo и clip.
+HSV гистограммы считаются по исходному разрешению и не измеряются.
+
+Запуск: poetry run measure_decode --limit 100 --k 5 --models classify photo clip
+"""
+import argparse, asyncio, os, time
+import numpy as np
+import torch
+from skimage.color import deltaE_ciede2000
+from finder import model_loader, photo, classifier, clip, ciedge2000
+from finder.compare_models import fetch_sample, neighbors, overlap, topk
+
+def timed(preprocess, images, reduced):
+    started = time.perf_counter()
+    outputs = [preprocess(file_data, reduced) for file_data in images]
+    return outputs, (time.perf_counter() - started) / len(images) * 1000
+
+def report(name, images, preprocess):
+    full, full_ms = timed(preprocess, images, False)
+    reduced, reduced_ms = timed(preprocess, images, True)
+    print(f"{name:14} полное {full_ms:7.2f} мс/изобр.  уменьшенное {reduced_ms:7.2f} мс/изобр.  "
+          f"ускорение x{full_ms / max(reduced_ms, 1e-9):.2f}")
+    return full, reduced
+
+def forward(model, tensors, batch_size=32):
+    with torch.no_grad():
+        return np.concatenate([model(torch.stack(tensors[i:i + batch_size])) for i in range(0, len(tensors), batch_size)])
+
+def compare_embeddings(name, full, reduced, k):
+    cosine = np.sum(full * reduced, axis=1) / np.maximum(np.linalg.norm(full, axis=1) * np.linalg.norm(reduced, axis=1), 1e-12)
+    k = min(k, len(full) - 1)
+    knn = overlap(neighbors(full, k), neighbors(reduced, k)) if k > 0 else None
+    print(f"{name:14} косинус полное/уменьшенное {cosine.mean():.4f}  пересечение {k} ближайших соседей {knn}")
+
+def measure_ciede(images, k):
+    full, reduced = report("ciedge2000", images, ciedge2000.lab_thumbnail)
+    delta = [deltaE_ciede2000(a.astype(np.float32), b.astype(np.float32)).mean() for a, b in zip(full, reduced)]
+    full_hists = np.array([ciedge2000.ab_histogram(thumbnail.astype(np.float32)) for thumbnail in full])
+    reduced_hists = np.array([ciedge2000.ab_histogram(thumbnail.astype(np.float32)) for thumbnail in reduced])
+    k = min(k, len(images) - 1)
+    if k <= 0:
+        return
+    # Пересечение гистограмм a/b внутри выборки - первый этап поиска ciedge2000
+    full_scores = np.minimum(full_hists[:, None, :], full_hists[None, :, :]).sum(axis=2)
+    reduced_scores = np.minimum(reduced_hists[:, None, :], reduced_hists[None, :, :]).sum(axis=2)
+    np.fill_diagonal(full_scores, -np.inf)
+    np.fill_diagonal(reduced_scores, -np.inf)
+    print(f"{'ciedge2000':14} средний CIEDE2000 между миниатюрами {np.mean(delta):.3f}  "
+          f"пересечение top-{k} по гистограммам a/b {overlap(topk(full_scores, k), topk(reduced_scores, k)):.3f}")
+
+def measure_classify(images, model_path):
+    full, reduced = report("classify", images, classifier.preprocess_image)
+    model = model_loader.load_classify_model(model_path)
+    agreement = np.mean(forward(model, full).argmax(axis=1) == forward(model, reduced).argmax(axis=1))
+    print(f"{'classify':14} совпадение классов {agreement:.3f}")
+
+def measure_photo(images, k):
+    full, reduced = report("photo", images, photo.preprocess_image)
+    model = model_loader.load_photo_model()
+    embed = lambda batch: model(batch).flatten(1)
+    compare_embeddings("photo", forward(embed, full), forward(embed, reduced), k)
+
+def measure_clip(images, k):
+    model, preprocess, device = model_loader.load_clip_model()
+    full, reduced = report("clip", images, lambda file_data, reduced: clip.apply_preprocess(preprocess, file_data, reduced))
+    embed = lambda batch: model.encode_image(batch.to(device)).float().cpu()
+    compare_embeddings("clip", forward(embed, full), forward(embed, reduced), k)
+
+def main():
+    parser = argparse.ArgumentParser(description="Время декодирования и изменение результатов при декодировании с уменьшением")
+    parser.add_argument("--limit", type=int, default=100, help="число изображений из selected_images")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--models", nargs="*", default=["ciedge2000", "classify", "photo", "clip"], choices=["ciedge2000", "classify", "photo", "clip"])
+    parser.add_argument("--model-path", default=os.getenv("MODEL_PATH"))
+    args = parser.parse_args()
+
+    images = asyncio.run(fetch_sample(args.limit))
+    print(f"Изображений: {len(images)}")
+    if "ciedge2000" in args.models:
+        measure_ciede(images, args.k)
+    if "classify" in args.models:
+        measure_classify(images, args.model_path)
+    if "photo" in args.models:
+        measure_photo(images, args.k)
+    if "clip" in args.models:
+        measure_clip(images, args.k)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import asyncio, os
+
+class MicroBatcher:
+    # Объединение одновременных запросов к модели в один пакетный forward pass.
+    # Первый запрос открывает пакет, пакет закрывается по достижении max_batch_size
+    # или через max_wait секунд; каждый вызывающий получает свой элемент результата.
+    # forward(список элементов) -> список результатов, выполняется через run (пул вычислений)
+    def __init__(self, forward, run, max_batch_size=None, max_wait=None):
+        self.forward = forward
+        self.run = run
+        self.max_batch_size = max_batch_size or int(os.getenv("CLASSIFY_MAX_BATCH_SIZE", 32))
+        self.max_wait = max_wait if max_wait is not None else float(os.getenv("CLASSIFY_MAX_WAIT_MS", 5)) / 1000
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    async def submit(self, item):
+        if self._task is None:
+            self._task = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Запросы, пришедшие во время ожидания, но не попавшие в пакет, остаются в очереди
+        return [(item, future) for item, future in batch if not future.cancelled()]
+
+    async def _collect(self):
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+            items, futures = zip(*batch)
+            try:
+                results = await self.run(self.forward, list(items))
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
@@ -1,24 +1,116 @@
-import torch, io, torchvision
+import torch, io, torchvision, os, threading, time
 from finder.utils import constants
 from torchvision.models import resnet50
 import clip
 
-def load_classify_model(model_path):
+# Варианты моделей для CPU: fp32 - исходная модель, int8 - динамическое квантование линейных слоев,
+# torchscript - трассированная и замороженная модель
+VARIANTS = ("fp32", "int8", "torchscript")
+# Динамическое квантование меняет только линейные слои: в ResNet50 для photo их нет (fc отрезан),
+# в ResNet18 классификатора это один последний слой, поэтому int8 допустим только для CLIP (ViT)
+MODEL_VARIANTS = {
+  "classify": ("fp32", "torchscript"),
+  "photo": ("fp32", "torchscript"),
+  "clip": VARIANTS,
+}
+
+def model_variant(name):
+  variant = os.getenv(f"{name.upper()}_MODEL_VARIANT", "fp32")
+  allowed = MODEL_VARIANTS.get(name, VARIANTS)
+  if variant not in allowed:
+    raise ValueError(f"Недопустимый вариант модели {name}: {variant}, допустимые значения: {allowed}")
+  return variant
+
+def feature_version(base_version, variant):
+  # Признаки разных вариантов модели хранятся в image_features раздельно
+  return base_version if variant == "fp32" else f"{base_version}-{variant}"
+
+def optimize_model(model, variant, example_input):
+  if variant == "int8":
+    if not any(isinstance(module, torch.nn.Linear) for module in model.modules()):
+      raise ValueError("В модели нет линейных слоев, динамическое квантование int8 ее не изменит")
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+  if variant == "torchscript":
+    with torch.no_grad():
+      return torch.jit.freeze(torch.jit.trace(model, example_input).eval())
+  return model
+
+def example_image_batch():
+  return torch.zeros(1, 3, constants.SIZE_224, constants.SIZE_224)
+
+def load_classify_model(model_path, variant="fp32"):
   model = torchvision.models.resnet18(pretrained=False)
   num_ftrs = model.fc.in_features
   model.fc = torch.nn.Linear(num_ftrs, len(constants.CLASSES))  # Изменение последнего слоя для соответствия количеству классов
   model.load_state_dict(torch.load(model_path))
   model.eval()
-  return model
+  return optimize_model(model, variant, example_image_batch())
 
-def load_photo_model():
+def load_photo_model(variant="fp32"):
   # Загрузка предобученной модели ResNet50
   model = resnet50(pretrained=True)
   model = torch.nn.Sequential(*list(model.children())[:-1])
   model.eval()
-  return model
+  return optimize_model(model, variant, example_image_batch())
 
-def load_clip_model():
+def load_clip_model(variant="fp32"):
   device = "cuda" if torch.cuda.is_available() else "cpu"
-  model, preprocess = clip.load("ViT-B/32", device=device)
+  # Для CLIP вариант torchscript - JIT-модель, которую поставляет сам пакет clip
+  model, preprocess = clip.load("ViT-B/32", device=device, jit=variant == "torchscript")
+  if variant == "int8" and device == "cpu":
+    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
   return model, preprocess, device
+
+def warm_up_image_model(model):
+  with torch.no_grad():
+    model(example_image_batch())
+
+def warm_up_clip_model(clip_model):
+  model, _, device = clip_model
+  with torch.no_grad():
+    model.encode_image(example_image_batch().to(device))
+    model.encode_text(clip.tokenize([""]).to(device))
+
+class LazyModel:
+  # Модель загружается при первом обращении (или заранее в фоне) и прогревается одним проходом.
+  # get() блокирует вызывающий поток до окончания загрузки, поэтому вызывается на пуле вычислений
+  def __init__(self, name, loader, warm_up, version=None):
+    self.name = name
+    self.variant = model_variant(name)
+    self.version = feature_version(version, self.variant) if version else None
+    self._loader = loader
+    self._warm_up = warm_up
+    self._lock = threading.Lock()
+    self._model = None
+    self.error = None
+    self.load_time = None
+
+  @property
+  def ready(self):
+    return self._model is not None
+
+  def get(self):
+    if self._model is None:
+      with self._lock:
+        if self._model is None:
+          started = time.perf_counter()
+          try:
+            model = self._loader(self.variant)
+            self._warm_up(model)
+          except Exception as e:
+            self.error = str(e)
+            raise
+          self.error = None
+          self.load_time = time.perf_counter() - started
+          self._model = model
+    return self._model
+
+  def state(self):
+    return {"ready": self.ready, "variant": self.variant, "load_time": self.load_time, "error": self.error}
+
+def create_models(model_path):
+  return {
+    "classify": LazyModel("classify", lambda variant: load_classify_model(model_path, variant), warm_up_image_model, constants.CLASSIFY_MODEL_VERSION),
+    "photo": LazyModel("photo", load_photo_model, warm_up_image_model, constants.PHOTO_MODEL_VERSION),
+    "clip": LazyModel("clip", load_clip_model, warm_up_clip_model, constants.CLIP_MODEL_VERSION),
+  }
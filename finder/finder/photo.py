@@ -1,68 +1,56 @@
-import torch, io, os
+import torch
 import torchvision.transforms as transforms
-from finder.utils import database, constants
-from PIL import Image
-import numpy as np
-from sklearn.neighbors import NearestNeighbors
-
-async def get_embedding_from_db(ctx, image_id):
+from finder.utils import constants
+from finder import features, decode
+
+def preprocess_image(file_data, reduced=True):
+    # Декодирование и предобработка изображения для ResNet50, декодер сразу уменьшает изображение до >= 256
+    with decode.pil_open(file_data, constants.SIZE_256 if reduced else None) as img:
+        # Проверяем количество каналов изображения
+        if img.mode != 'RGB':
+            img = img.convert('RGB')  # Преобразуем изображение в RGB, удаляя альфа-канал
+        preprocess = transforms.Compose([
+            transforms.Resize(constants.SIZE_256),
+            transforms.CenterCrop(constants.SIZE_224),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=constants.MEAN, std=constants.STD),
+        ])
+        return preprocess(img)
+
+def embed_batch(ctx, tensors):
+    # Эмбеддинги ResNet50 для пакета изображений
+    return ctx.photo_model.get()(torch.stack(tensors)).flatten(1).numpy()
+
+async def index_new_images(ctx, current_ids=None):
+    # Эмбеддинги считаются один раз, для новых строк selected_images, и попадают в индекс без полной перестройки
+    await features.sync_index(ctx, ctx.photo_index, ctx.photo_model.version, preprocess_image, lambda tensors: embed_batch(ctx, tensors), rendition=constants.SIZE_256, current_ids=current_ids)
+
+async def reindex(ctx):
+    async with ctx.indexer.lock:
+        indexed = await features.reindex(ctx, ctx.photo_model.version, preprocess_image, lambda tensors: embed_batch(ctx, tensors), rendition=constants.SIZE_256)
+        ctx.photo_index.clear()
+        await index_new_images(ctx)
+    return indexed
+
+async def search_similar_images(query_image_ids, ctx, n_neighbors):
+    # Поиск соседей сразу для пакета изображений-запросов по индексу ctx.photo_index
     try:
-        async with ctx.db_handle.acquire() as conn:
-            image_data = await database.fetch_row_selected_image(conn, image_id)
-        with Image.open(io.BytesIO(image_data['file_data'])) as img:
-            # Проверяем количество каналов изображения
-            if img.mode == 'RGBA':
-                img = img.convert('RGB')  # Преобразуем изображение в RGB, удаляя альфа-канал
-            preprocess = transforms.Compose([
-                transforms.Resize(constants.SIZE_256),
-                transforms.CenterCrop(constants.SIZE_224),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=constants.MEAN, std=constants.STD),
-            ])
-            image = preprocess(img)
-            image = image.unsqueeze(0)
-            with torch.no_grad():
-                embedding = ctx.photo_model(image)
-            return embedding.squeeze().numpy()
-    except Exception as e:
-        ctx.logger.error(f"Ошибка при получении эмбеддинга изображения: {e}")
-        raise
-
-async def search_similar_images(query_image_id, ctx, n_neighbors):
-    try:
-        # Создание объекта NearestNeighbors для поиска ближайших соседей
-        knn = NearestNeighbors(n_neighbors, metric=os.getenv("PHOTO_METRI"))  # Используем косинусную метрику
-
-        # Получаем эмбеддинг запроса изображения из базы данных
-        query_embedding = await get_embedding_from_db(ctx, query_image_id)
-
-        # Извлекаем все записи из базы данных для поиска соседей
-        async with ctx.db_handle.acquire() as conn:
-            async with conn.transaction():
-                rows = await database.fetch_selected_images_ids(conn)
-        ids = [row['id'] for row in rows]
-
-        embeddings = []
-        for image_id in ids:
-            embedding = await get_embedding_from_db(ctx, image_id)
-            embeddings.append(embedding)
-
-        # Преобразование списка эмбеддингов в numpy массив
-        embeddings = np.array(embeddings)
-
-        # Обучение модели NearestNeighbors
-        knn.fit(embeddings)
-
-        # Поиск ближайших соседей для запроса изображения
-        distances, indices = knn.kneighbors([query_embedding])
+        # Эмбеддинги запросов берутся из индекса, без обращения к модели
+        query_embeddings = await ctx.compute.run(ctx.photo_index.vectors, query_image_ids)
+        neighbor_ids, _ = await ctx.compute.run(ctx.photo_index.search, query_embeddings, n_neighbors)
 
         # Возвращаем id из базы данных тех изображений, которые оказались самыми похожими на запрос
-        return [ids[i] for i in indices[0]]
+        return [[int(image_id) for image_id in row] for row in neighbor_ids]
+    except KeyError as e:
+        # Изображение еще не проиндексировано - внеочередной проход индексации
+        ctx.indexer.request()
+        ctx.logger.error(f"Ошибка при поиске похожих изображений: {e}")
+        raise
     except Exception as e:
         ctx.logger.error(f"Ошибка при поиске похожих изображений: {e}")
         raise
 
 # Пример использования функции поиска и отображения похожих изображений
 async def find_by_photo(target_image_id, ctx, n_neighbors):
-    similar_image_ids = await search_similar_images(target_image_id, ctx, n_neighbors)
-    return similar_image_ids
+    similar_image_ids = await search_similar_images([target_image_id], ctx, n_neighbors)
+    return similar_image_ids[0]
@@ -0,0 +1,69 @@
+import logging
+from types import SimpleNamespace
+import cv2
+import numpy as np
+import pytest
+from finder import hsv
+
+ctx = SimpleNamespace(logger=logging.getLogger("test_hsv"))
+
+def encoded_image(rng, background):
+    # Несколько цветных прямоугольников на однотонном фоне, как у изображений с удаленным фоном
+    image = np.full((96, 96, 3), background, dtype=np.uint8)
+    for _ in range(rng.integers(1, 6)):
+        x, y = rng.integers(0, 80, 2)
+        w, h = rng.integers(8, 40, 2)
+        image[y:y + h, x:x + w] = rng.integers(0, 256, 3)
+    image = cv2.add(image, rng.integers(0, 12, image.shape, dtype=np.uint8))
+    return cv2.imencode(".png", image)[1].tobytes()
+
+@pytest.fixture(scope="module")
+def corpus():
+    rng = np.random.default_rng(5)
+    ids = np.arange(1, 41, dtype=np.int64) * 10
+    hists = [hsv.calculate_hist_hsv(encoded_image(rng, (0, 0, 0) if i % 2 else (255, 255, 255)), ctx) for i in range(len(ids))]
+    index = hsv.HistogramIndex()
+    # Гистограммы проходят через формат хранения image_features
+    index.add(ids, [hsv.bytes_to_hist(hsv.hist_to_bytes(hist)) for hist in hists])
+    return ids, hists, index
+
+def compare_hist_distances(ids, hists, position):
+    return {
+        int(image_id): cv2.compareHist(hists[position], hist, cv2.HISTCMP_BHATTACHARYYA)
+        for image_id, hist in zip(ids, hists) if image_id != ids[position]
+    }
+
+@pytest.mark.parametrize("position", [0, 1, 17, 39])
+def test_search_matches_compare_hist(corpus, position):
+    ids, hists, index = corpus
+    expected = compare_hist_distances(ids, hists, position)
+
+    result = index.search(ids[position], len(ids))
+
+    assert sorted(image_id for image_id, _ in result) == sorted(expected)
+    distances = [distance for _, distance in result]
+    assert distances == sorted(distances)
+    for image_id, distance in result:
+        assert distance == pytest.approx(expected[image_id], abs=1e-5)
+
+@pytest.mark.parametrize("top_n", [1, 3, 10])
+def test_top_n_are_nearest_by_compare_hist(corpus, top_n):
+    ids, hists, index = corpus
+    expected = compare_hist_distances(ids, hists, 5)
+
+    result = index.search(ids[5], top_n)
+
+    assert len(result) == top_n
+    assert [distance for _, distance in result] == pytest.approx(sorted(expected.values())[:top_n], abs=1e-5)
+
+def test_removed_and_missing_images(corpus):
+    ids, hists, _ = corpus
+    index = hsv.HistogramIndex()
+    index.add(ids, [hsv.bytes_to_hist(hsv.hist_to_bytes(hist)) for hist in hists])
+    index.remove(ids[1:3])
+
+    result = index.search(ids[0], len(ids))
+
+    assert {image_id for image_id, _ in result}.isdisjoint(ids[1:3].tolist())
+    with pytest.raises(ValueError):
+        index.search(ids[1], 3)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+from finder import knn_index
+
+def brute_force(ids, vectors, queries, metric, k):
+    # Все расстояния cdist и k наименьших для каждого запроса
+    distances = cdist(queries.astype(np.float64), vectors.astype(np.float64), metric=metric)
+    return {image_id: distances[:, position] for position, image_id in enumerate(ids.tolist())}, np.sort(distances, axis=1)[:, :k]
+
+def check_search(index, ids, vectors, queries, k):
+    by_id, nearest = brute_force(ids, vectors, queries, index.metric, k)
+
+    result_ids, result_distances = index.search(queries, k)
+
+    assert result_ids.shape == result_distances.shape == (len(queries), min(k, len(ids)))
+    # Найденные расстояния - k наименьших по cdist (с точностью float32), в порядке возрастания
+    np.testing.assert_allclose(result_distances, nearest, atol=1e-4)
+    assert np.all(np.diff(result_distances, axis=1) >= 0)
+    # и это действительно расстояния до возвращенных id
+    for row, (row_ids, row_distances) in enumerate(zip(result_ids, result_distances)):
+        assert len(set(row_ids.tolist())) == len(row_ids)
+        np.testing.assert_allclose(row_distances, [by_id[image_id][row] for image_id in row_ids.tolist()], atol=1e-4)
+
+@pytest.mark.parametrize("metric", knn_index.METRICS)
+@pytest.mark.parametrize("k", [1, 5, 20])
+def test_search_matches_cdist(metric, k):
+    rng = np.random.default_rng(2)
+    ids = rng.permutation(10_000)[:300].astype(np.int64)
+    vectors = rng.normal(size=(300, 64)).astype(np.float32) * rng.uniform(0.5, 3.0, size=(300, 1)).astype(np.float32)
+    queries = rng.normal(size=(25, 64)).astype(np.float32)
+    index = knn_index.VectorIndex(metric, capacity=16)
+    # Несколько добавлений - с ростом буфера
+    for start in range(0, len(ids), 70):
+        index.add(ids[start:start + 70], vectors[start:start + 70])
+
+    check_search(index, ids, vectors, queries, k)
+
+@pytest.mark.parametrize("metric", knn_index.METRICS)
+def test_search_after_replace_and_remove(metric):
+    rng = np.random.default_rng(3)
+    ids = np.arange(200, dtype=np.int64)
+    vectors = rng.normal(size=(200, 32)).astype(np.float32)
+    queries = rng.normal(size=(10, 32)).astype(np.float32)
+    index = knn_index.VectorIndex(metric)
+    index.add(ids, vectors)
+
+    vectors[:20] = rng.normal(size=(20, 32)).astype(np.float32)
+    index.add(ids[:20], vectors[:20])
+    index.remove(ids[150:])
+
+    check_search(index, ids[:150], vectors[:150], queries, 10)
+    np.testing.assert_allclose(index.vectors(ids[:5].tolist()), vectors[:5], rtol=1e-5, atol=1e-5)
+
+def test_k_larger_than_index():
+    index = knn_index.VectorIndex()
+    index.add([1, 2, 3], np.eye(3, dtype=np.float32))
+
+    result_ids, result_distances = index.search(np.array([1.0, 0.1, 0.0], dtype=np.float32), 10)
+
+    assert result_ids.tolist() == [[1, 2, 3]]
+    assert result_distances.shape == (1, 3)
+
+def test_vectors_lookup_by_id():
+    rng = np.random.default_rng(4)
+    ids = rng.permutation(1000)[:100].astype(np.int64)
+    vectors = rng.normal(size=(100, 16)).astype(np.float32)
+    index = knn_index.VectorIndex()
+    index.add(ids[:60], vectors[:60])
+    index.add(ids[60:], vectors[60:])
+
+    np.testing.assert_allclose(index.vectors(ids[::-7].tolist()), vectors[::-7], rtol=1e-5, atol=1e-5)
+    with pytest.raises(KeyError):
+        index.vectors([int(ids[0]), 5000])
+    with pytest.raises(KeyError):
+        knn_index.VectorIndex().vectors([1])
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+from finder import lab_store
+
+def thumbnails(ids):
+    # Миниатюра, заполненная значением id, чтобы проверять, что слот содержит данные своего изображения
+    return np.stack([np.full(lab_store.THUMBNAIL_SHAPE, image_id % 256, dtype=np.uint8) for image_id in ids])
+
+def check_contents(store, ids):
+    assert sorted(store.ids().tolist()) == sorted(ids)
+    for image_id in ids:
+        assert np.all(store.get(image_id) == image_id % 256)
+    image_ids, slots, data_path = store.slots(ids)
+    on_disk = lab_store.open_thumbnails(data_path)
+    for image_id, slot in zip(image_ids, slots):
+        assert np.all(on_disk[slot] == image_id % 256)
+
+def data_slots(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.endswith(".u8")) // lab_store.THUMBNAIL_BYTES
+
+def test_add_remove_cycles_keep_file_bounded(tmp_path):
+    store = lab_store.LabThumbnailStore(str(tmp_path))
+    live = []
+    for cycle in range(5):
+        ids = list(range(cycle * 10 + 1, cycle * 10 + 11))
+        store.add(ids, thumbnails(ids))
+        store.remove(ids[1:])
+        live.append(ids[0])
+        check_contents(store, live)
+
+    # Сжатие оставляет файл текущего поколения и не больше одного предыдущего
+    assert data_slots(str(tmp_path)) <= 2 * (len(live) + 10)
+    assert len(lab_store.open_thumbnails(store.slots(live)[2])) <= len(live) / (1 - store.compact_ratio) + 10
+
+def test_replaced_thumbnails_and_reopen(tmp_path):
+    store = lab_store.LabThumbnailStore(str(tmp_path))
+    store.add([1, 2, 3], thumbnails([1, 2, 3]))
+    for _ in range(4):
+        store.add([2, 3], thumbnails([2, 3]))
+    check_contents(store, [1, 2, 3])
+
+    reopened = lab_store.LabThumbnailStore(str(tmp_path))
+
+    assert reopened.generation == store.generation > 0
+    check_contents(reopened, [1, 2, 3])
+    assert data_slots(str(tmp_path)) == len(lab_store.open_thumbnails(reopened.slots([1])[2]))
+
+def test_files_of_other_versions_are_removed(tmp_path):
+    (tmp_path / "lab_thumbnails_v1.u8").write_bytes(b"\0" * lab_store.THUMBNAIL_BYTES)
+    (tmp_path / "lab_thumbnails_v1_ids.npy").write_bytes(b"")
+    (tmp_path / "unrelated.txt").write_text("keep")
+
+    store = lab_store.LabThumbnailStore(str(tmp_path))
+    store.add([7], thumbnails([7]))
+
+    assert sorted(os.listdir(tmp_path)) == sorted(["unrelated.txt", f"lab_thumbnails_{lab_store.STORE_VERSION}.u8", f"lab_thumbnails_{lab_store.STORE_VERSION}_ids.npy"])
+    check_contents(store, [7])
@@ -0,0 +1,167 @@
+import asyncio, json, logging, os
+import httpx
+from fastapi import HTTPException, status
+from manager.utils import database
+
+logger = logging.getLogger(__name__)
+
+# Тип задания -> сервис и переменная окружения с адресом эндпоинта
+JOB_TYPES = {
+    "scrap": ("scrapper", "SCRAP_URL_SCRAP"),
+    "rem_bg": ("modificator", "MODIFICATOR_URL_REM_BG"),
+    "rem_dup": ("modificator", "MODIFICATOR_URL_REM_DUP"),
+    "pyramid": ("modificator", "MODIFICATOR_URL_PYRAMID"),
+    "renditions": ("modificator", "MODIFICATOR_URL_RENDITIONS"),
+}
+
+class JobRunner:
+    # Очередь долгих заданий в таблице jobs: отправка сразу возвращает id задания,
+    # воркеры (JOBS_<ТИП>_WORKERS на каждый тип) забирают задания и вызывают сервисы.
+    # Сервисы сами пишут прогресс и результат в jobs. Выполняющееся задание держит аренду: manager и сервис
+    # продлевают jobs.heartbeat_at, в очередь возвращаются только задания без отметки дольше JOBS_LEASE секунд.
+    # Перезапуск manager не запускает выполняющееся в сервисе задание второй раз, а задание, прерванное
+    # остановкой сервиса (или недоступностью сервиса), выполняется заново
+    def __init__(self, db_handle, request_manager, on_run=None, on_done=None):
+        self.db_handle = db_handle
+        self.request_manager = request_manager
+        self.on_run = on_run or (lambda job_type: None)
+        # Асинхронное действие после завершения задания, выполняется в фоне и не занимает воркер
+        self.on_done = on_done
+        self.poll_interval = float(os.getenv("JOBS_POLL_INTERVAL", 5))
+        self.timeout = float(os.getenv("JOBS_TIMEOUT", 24 * 60 * 60))
+        self.heartbeat_interval = float(os.getenv("JOBS_HEARTBEAT_INTERVAL", 10))
+        self.lease = float(os.getenv("JOBS_LEASE", 60))
+        self._wakeups = {job_type: asyncio.Event() for job_type in JOB_TYPES}
+        self._workers = []
+        self._callbacks = set()
+
+    async def start(self):
+        self._workers.append(asyncio.create_task(self._reaper()))
+        for job_type in JOB_TYPES:
+            workers = int(os.getenv(f"JOBS_{job_type.upper()}_WORKERS", 1))
+            self._workers.extend(asyncio.create_task(self._worker(job_type)) for _ in range(workers))
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    async def submit(self, job_type, params=None):
+        # Повторная отправка задания с теми же параметрами возвращает id уже поставленного
+        params = params or {}
+        dedupe_key = f"{job_type}:{json.dumps(params, sort_keys=True)}"
+        async with self.db_handle.acquire() as conn:
+            job_id, created = await database.submit_job(conn, job_type, params, dedupe_key)
+        self._wakeups[job_type].set()
+        return {"job_id": job_id, "created": created}
+
+    async def get(self, job_id):
+        async with self.db_handle.acquire() as conn:
+            row = await database.fetch_job(conn, job_id)
+        if row is None:
+            raise HTTPException(status_code=404, detail=f"Задание {job_id} не найдено")
+        job = dict(row)
+        job["params"] = json.loads(job["params"]) if job["params"] is not None else {}
+        elapsed = None
+        if job["started_at"] is not None:
+            elapsed = ((job["finished_at"] or job["updated_at"]) - job["started_at"]).total_seconds()
+        job["elapsed"] = elapsed
+        job["throughput"] = job["processed"] / elapsed if elapsed else None
+        return job
+
+    async def _next_job(self, job_type):
+        wakeup = self._wakeups[job_type]
+        while True:
+            wakeup.clear()
+            async with self.db_handle.acquire() as conn:
+                job = await database.claim_job(conn, job_type)
+            if job is not None:
+                return job
+            try:
+                await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _reaper(self):
+        # Возврат в очередь заданий с истекшей арендой, в том числе оставшихся от прошлого запуска manager
+        while True:
+            try:
+                async with self.db_handle.acquire() as conn:
+                    rows = await database.requeue_expired_jobs(conn, self.lease)
+                for row in rows:
+                    self._wakeups[row["job_type"]].set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Не удалось вернуть в очередь задания с истекшей арендой: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def _heartbeat(self, job_id):
+        # Аренда продлевается, пока ожидается ответ сервиса: так задание не вернется в очередь,
+        # даже если сервис сам не отмечает heartbeat_at (например, pyramid)
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                async with self.db_handle.acquire() as conn:
+                    await database.heartbeat_job(conn, job_id)
+            except Exception:
+                pass
+
+    async def _worker(self, job_type):
+        # Ошибка одной итерации (например, база недоступна) не останавливает воркер
+        while True:
+            try:
+                await self._run_next(job_type)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка воркера заданий {job_type}: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _run_next(self, job_type):
+        upstream, url_key = JOB_TYPES[job_type]
+        job_id, params = await self._next_job(job_type)
+        state, error = "done", None
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        self.on_run(job_type)
+        try:
+            result = await self.request_manager.post(upstream, os.getenv(url_key), {**params, "job_id": job_id}, self.timeout)
+            if result['status_code'] >= 400:
+                state, error = "failed", json.dumps(result['data'], ensure_ascii=False)
+        except asyncio.CancelledError:
+            raise
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+            # Запрос не дошел до сервиса - задание выполняется заново
+            state = "queued"
+        except HTTPException as e:
+            # Запрос отклонен очередью Upstream (переполнена или ожидание истекло) и не отправлялся
+            if e.status_code in (status.HTTP_429_TOO_MANY_REQUESTS, status.HTTP_503_SERVICE_UNAVAILABLE):
+                state = "queued"
+            else:
+                state, error = "failed", str(e.detail)
+        except httpx.TimeoutException:
+            state, error = "failed", f"Задание не завершилось за {self.timeout:.0f} с"
+        except httpx.TransportError as e:
+            # Соединение оборвалось после отправки: сервис может еще выполнять задание и продлевать аренду.
+            # Задание остается running - результат запишет сервис, иначе аренда истечет и задание вернется в очередь
+            logger.error(f"Соединение с {upstream} оборвалось во время задания {job_id}: {e!r}")
+            state = None
+        except Exception as e:
+            state, error = "failed", str(getattr(e, "detail", e)) or type(e).__name__
+        finally:
+            heartbeat.cancel()
+            self.on_run(job_type)
+        if state is None:
+            return
+        if state == "queued":
+            async with self.db_handle.acquire() as conn:
+                await database.requeue_job(conn, job_id)
+            await asyncio.sleep(self.poll_interval)
+            return
+        # Если сервис уже записал результат задания, запись manager его не меняет
+        async with self.db_handle.acquire() as conn:
+            await database.finish_job(conn, job_id, state, error)
+        if self.on_done is not None:
+            task = asyncio.ensure_future(self.on_done(job_type, state))
+            self._callbacks.add(task)
+            task.add_done_callback(self._callbacks.discard)
@@ -1,9 +1,61 @@
 import uvicorn, os, asyncio
 from fastapi import FastAPI
-from manager.utils.models import ClipParams, ImageIdParams, PyramidParams, ScraperParams, PhotoFinderParams
+from manager.utils.models import ClipParams, ImageIdParams, ClassifyBulkParams, PyramidParams, ScraperParams, PhotoFinderParams, HsvParams, CiedeParams, CiedeRecallParams
 from manager.request_manager import RequestManager
+from manager.result_cache import ResultCache
+from manager.jobs import JobRunner
+from manager.utils import database
 
 app = FastAPI()
+request_manager = None
+job_runner = None
+db_handle = None
+result_cache = ResultCache()
+
+def invalidate_cache(job_type):
+    # Задания, меняющие корпус, сбрасывают кэш до и после выполнения
+    if job_type in ("rem_bg", "rem_dup"):
+        result_cache.invalidate()
+
+async def refresh_index(job_type, state):
+    # После изменения корпуса finder индексирует новые изображения, затем кэш результатов сбрасывается еще раз.
+    # Если finder недоступен, изображения проиндексируются его периодическим проходом
+    if job_type not in ("rem_bg", "rem_dup"):
+        return
+    try:
+        await request_manager.post("finder", os.getenv("FINDER_URL_INDEX"), None, float(os.getenv("FINDER_INDEX_TIMEOUT", 3600)))
+    except Exception:
+        pass
+    result_cache.invalidate()
+
+@app.on_event("startup")
+async def startup_event():
+    global request_manager, job_runner, db_handle
+    request_manager = RequestManager()
+    db_handle = await database.connect()
+    await database.migrate(db_handle)
+    job_runner = JobRunner(db_handle, request_manager, invalidate_cache, refresh_index)
+    await job_runner.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await job_runner.close()
+    await database.disconnect(db_handle)
+    await request_manager.close()
+
+@app.get("/stats")
+async def stats():
+    """Загрузка сервисов (выполняемые запросы, глубина очереди, время ожидания) и статистика кэша результатов"""
+    return {"upstreams": request_manager.stats(), "result_cache": result_cache.stats()}
+
+async def cached_post(upstream, url_key, json_data):
+    # Запросы поиска зависят только от параметров и содержимого selected_images, поэтому кэшируются
+    return await result_cache.get_or_fetch(url_key, json_data, lambda: request_manager.post(upstream, os.getenv(url_key), json_data))
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: int):
+    """Состояние задания, число обработанных элементов и скорость обработки"""
+    return await job_runner.get(job_id)
 
 @app.post("/scrap")
 async def scrap(request: ScraperParams):
@@ -11,15 +63,15 @@ async def scrap(request: ScraperParams):
         "start_url": request.start_url,
         "max_images": request.max_images
     }
-    return await RequestManager.post(os.getenv("SCRAP_URL_SCRAP"), json_data)
+    return await job_runner.submit("scrap", json_data)
 
 @app.post("/rem_bg")
 async def rem_bg():
-    return await RequestManager.post(os.getenv("MODIFICATOR_URL_REM_BG"), None)
+    return await job_runner.submit("rem_bg")
 
 @app.post("/rem_dup")
 async def rem_dup():
-    return await RequestManager.post(os.getenv("MODIFICATOR_URL_REM_DUP"), None)
+    return await job_runner.submit("rem_dup")
 
 @app.post("/pyramid")
 async def pyramid(request: PyramidParams):
@@ -27,21 +79,36 @@ async def pyramid(request: PyramidParams):
         "first_image_id": request.first_image_id,
         "second_image_id": request.second_image_id
     }
-    return await RequestManager.post(os.getenv("MODIFICATOR_URL_PYRAMID"), json_data)
+    return await job_runner.submit("pyramid", json_data)
+
+@app.post("/renditions")
+async def renditions():
+    return await job_runner.submit("renditions")
 
 @app.post("/hsv")
-async def hsv(request: ImageIdParams):
+async def hsv(request: HsvParams):
     json_data = {
-        "image_id": request.image_id
+        "image_id": request.image_id,
+        "top_n": request.top_n
     }
-    return await RequestManager.post(os.getenv("FINDER_URL_HSV"), json_data)
+    return await cached_post("finder", "FINDER_URL_HSV", json_data)
 
 @app.post("/ciedge2000")
-async def ciedge2000(request: ImageIdParams):
+async def ciedge2000(request: CiedeParams):
     json_data = {
-        "image_id": request.image_id
+        "image_id": request.image_id,
+        "shortlist": request.shortlist,
+        "exhaustive": request.exhaustive
     }
-    return await RequestManager.post(os.getenv("FINDER_URL_CIEDGE"), json_data)
+    return await cached_post("finder", "FINDER_URL_CIEDGE", json_data)
+
+@app.post("/ciedge2000/recall")
+async def ciedge2000_recall(request: CiedeRecallParams):
+    json_data = {
+        "image_ids": request.image_ids,
+        "shortlist": request.shortlist
+    }
+    return await request_manager.post("finder", os.getenv("FINDER_URL_CIEDGE_RECALL"), json_data)
 
 @app.post("/photo")
 async def photo(request: PhotoFinderParams):
@@ -49,21 +116,41 @@ async def photo(request: PhotoFinderParams):
         "image_id": request.image_id,
         "n_neighbors": request.n_neighbors
     }
-    return await RequestManager.post(os.getenv("FINDER_URL_PHOTO"), json_data)
+    return await cached_post("finder", "FINDER_URL_PHOTO", json_data)
+
+@app.post("/photo/reindex")
+async def photo_reindex():
+    return await request_manager.post("finder", os.getenv("FINDER_URL_PHOTO_REINDEX"), None)
 
 @app.post("/classify")
 async def classify(request: ImageIdParams):
     json_data = {
         "image_id": request.image_id
     }
-    return await RequestManager.post(os.getenv("FINDER_URL_CLASS"), json_data)
+    return await cached_post("finder", "FINDER_URL_CLASS", json_data)
+
+@app.post("/classify/bulk")
+async def classify_bulk(request: ClassifyBulkParams):
+    json_data = {
+        "image_ids": request.image_ids,
+        "all_images": request.all_images
+    }
+    return await request_manager.post("finder", os.getenv("FINDER_URL_CLASS_BULK"), json_data)
 
 @app.post("/clip")
 async def clip(request: ClipParams):
     json_data = {
         "search_text": request.search_text
     }
-    return await RequestManager.post(os.getenv("FINDER_URL_CLIP"), json_data)
+    return await cached_post("finder", "FINDER_URL_CLIP", json_data)
+
+@app.post("/index")
+async def index():
+    return await request_manager.post("finder", os.getenv("FINDER_URL_INDEX"), None, float(os.getenv("FINDER_INDEX_TIMEOUT", 3600)))
+
+@app.post("/clip/reindex")
+async def clip_reindex():
+    return await request_manager.post("finder", os.getenv("FINDER_URL_CLIP_REINDEX"), None)
 
 def start():
   """Launched with `poetry run start`"""
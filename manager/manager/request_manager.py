@@ -1,12 +1,94 @@
-import os
+import asyncio, os, time
 import httpx
+from fastapi import HTTPException, status
+
+class Upstream:
+    # Долгоживущий клиент к одному сервису (finder, modificator, scrapper) с пулом keep-alive соединений.
+    # Одновременно выполняется не больше concurrency запросов, остальные ждут в очереди ограниченной длины.
+    # При переполненной очереди запрос сразу отклоняется с 429, при слишком долгом ожидании - с 503
+    def __init__(self, name):
+        prefix = name.upper()
+        self.name = name
+        self.concurrency = int(os.getenv(f"{prefix}_CONCURRENCY", os.getenv("UPSTREAM_CONCURRENCY", 8)))
+        self.queue_size = int(os.getenv(f"{prefix}_QUEUE_SIZE", os.getenv("UPSTREAM_QUEUE_SIZE", 32)))
+        self.queue_timeout = float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", os.getenv("UPSTREAM_QUEUE_TIMEOUT", 30)))
+        self.client = httpx.AsyncClient(
+            timeout=float(os.getenv("MAX_TIMEOUT")),
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+        )
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _reject(self, status_code, detail):
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": "1"})
+
+    async def _acquire(self):
+        if self.waiting >= self.queue_size and self._semaphore.locked():
+            self.rejected += 1
+            self._reject(status.HTTP_429_TOO_MANY_REQUESTS, f"Очередь запросов к {self.name} переполнена")
+
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, f"Сервис {self.name} перегружен")
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - started
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    async def post(self, url, json_data, timeout=httpx.USE_CLIENT_DEFAULT):
+        await self._acquire()
+        self.in_flight += 1
+        try:
+            return await self.client.post(url, json=json_data, timeout=timeout)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait": self.total_wait / self.completed if self.completed else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+    async def close(self):
+        await self.client.aclose()
 
 class RequestManager:
-    @staticmethod
-    async def post(url, json_data):
-        async with httpx.AsyncClient() as client:
-          response = await client.post(url, json=json_data, timeout=float(os.getenv("MAX_TIMEOUT")))
-          return {
-              'status_code': response.status_code,
-              'data': response.json()
-          }
\ No newline at end of file
+    # Клиенты к сервисам создаются один раз при запуске приложения и переиспользуются всеми запросами
+    def __init__(self, upstreams=("scrapper", "modificator", "finder")):
+        self.upstreams = {name: Upstream(name) for name in upstreams}
+
+    async def post(self, upstream, url, json_data, timeout=httpx.USE_CLIENT_DEFAULT):
+        response = await self.upstreams[upstream].post(url, json_data, timeout)
+        return {
+            'status_code': response.status_code,
+            'data': response.json()
+        }
+
+    def stats(self):
+        return {name: upstream.stats() for name, upstream in self.upstreams.items()}
+
+    async def close(self):
+        await asyncio.gather(*(upstream.close() for upstream in self.upstreams.values()))
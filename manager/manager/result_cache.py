@@ -0,0 +1,87 @@
+import asyncio, json, os, time
+from collections import OrderedDict
+
+class ResultCache:
+    # Кэш ответов сервисов поиска: ключ - эндпоинт и параметры запроса, вытеснение по TTL и LRU.
+    # Одинаковые одновременные запросы объединяются в один запрос к сервису (singleflight).
+    # Каждая инвалидация увеличивает поколение кэша: ответ, запрошенный до изменения корпуса, в кэш не попадает
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize if maxsize is not None else int(os.getenv("RESULT_CACHE_SIZE", 1024))
+        self.ttl = ttl if ttl is not None else float(os.getenv("RESULT_CACHE_TTL", 300))
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(endpoint, params):
+        return endpoint, json.dumps(params, sort_keys=True)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def _fetch(self, key, fetch):
+        generation = self._generation
+        try:
+            result = await fetch()
+            if result['status_code'] == 200 and generation == self._generation:
+                self._put(key, result)
+            return result
+        finally:
+            if self._in_flight.get(key) is asyncio.current_task():
+                del self._in_flight[key]
+
+    async def get_or_fetch(self, endpoint, params, fetch):
+        key = self.key(endpoint, params)
+        result = self._get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        task = self._in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            self._in_flight[key] = task
+        else:
+            self.coalesced += 1
+        # Отмена одного из ожидающих клиентов не отменяет общий запрос к сервису
+        return await asyncio.shield(task)
+
+    def invalidate(self):
+        self._generation += 1
+        self._entries.clear()
+        self._in_flight.clear()
+        self.invalidations += 1
+
+    def stats(self):
+        requests = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / requests if requests else 0.0,
+            "invalidations": self.invalidations,
+        }
@@ -1,44 +1,73 @@
-import io, imagehash, os, asyncio, asyncpg, logging
-from PIL import Image
-from modificator.utils import database
-
-async def find_duplicate_and_unique_images(ctx, threshold=int(os.getenv("THRESHOLD"))):
-  images = {}
-  duplicates = []
-  unique_images = []
+import os, asyncio
+from concurrent.futures import ProcessPoolExecutor
+from modificator.utils import database, phash
+
+def compute_phash(image_id, file_data):
+  try:
+    return image_id, phash.phash_int(file_data), None
+  except Exception as e:
+    return image_id, None, str(e)
+
+async def hash_batch(ctx, pool, rows):
+  loop = asyncio.get_running_loop()
+  # Данные из хранилища файлов (memoryview над mmap) передаются в процессы как bytes
+  results = await asyncio.gather(*(loop.run_in_executor(pool, compute_phash, row["id"], bytes(row["file_data"])) for row in rows))
+
+  records = []
+  for image_id, img_hash, error in results:
+    if error is not None:
+      ctx.logger.error(f"Не удалось посчитать хэш изображения с id {image_id}: {error}")
+    else:
+      records.append((image_id, img_hash))
+
   async with ctx.db_handle.acquire() as conn:
-    async with conn.transaction():
-      all_images = await database.fetch_all_scrapped_images_images(conn)
-      for row in all_images:
-        file_data = row["file_data"]
-        with Image.open(io.BytesIO(file_data)) as img:
-          img_hash = str(imagehash.phash(img))
+    await database.update_phashes(conn, records)
+  return len(records)
 
-        found_similar = False
-        for key, val in images.items():
-          if imagehash.hex_to_hash(img_hash) - imagehash.hex_to_hash(key) < threshold:
-            duplicates.append((val, row["id"]))
-            found_similar = True
-            break
+async def hash_missing_images(ctx, progress):
+  # Перцептивные хэши считаются один раз, параллельно по процессам, только для строк без хэша.
+  # Строки читаются страницами, в памяти одновременно не больше DB_PREFETCH изображений
+  batch_size = int(os.getenv("DB_PREFETCH", 50))
+  hashed = 0
+  with ProcessPoolExecutor(max_workers=int(os.getenv("PHASH_WORKERS", os.cpu_count()))) as pool:
+    batch = []
+    async for row in database.iterate_scrapped_images_without_phash(ctx.db_handle, batch_size):
+      batch.append(row)
+      if len(batch) == batch_size:
+        hashed += await hash_batch(ctx, pool, batch)
+        batch = []
+        await progress.update(hashed)
+    if batch:
+      hashed += await hash_batch(ctx, pool, batch)
+
+  if hashed:
+    ctx.logger.info(f"Посчитаны хэши для {hashed} изображений")
+  return hashed
+
+async def find_duplicate_and_unique_images(ctx, progress, threshold=int(os.getenv("THRESHOLD"))):
+  await hash_missing_images(ctx, progress)
+
+  async with ctx.db_handle.acquire() as conn:
+    all_hashes = await database.fetch_scrapped_images_phashes(conn)
 
-        if not found_similar:
-          images[img_hash] = row["id"]
-          unique_images.append(row["id"])
+  # Поиск похожего хэша среди оставленных изображений через BK-дерево
+  unique_images, duplicates = phash.split_duplicates(all_hashes, threshold)
 
-      async with ctx.db_handle.acquire() as conn:
-        async with conn.transaction():
-          for _, duplicate_id in duplicates:
-            await database.delete_duplicate_image(conn, duplicate_id)
-            ctx.logger.info(f"Удалено изображение-дубликат с id {duplicate_id}")
+  await progress.update(len(all_hashes), len(all_hashes), force=True)
+  if duplicates:
+    async with ctx.db_handle.acquire() as conn:
+      await database.delete_duplicate_images(conn, [duplicate_id for _, duplicate_id in duplicates])
+    for original_id, duplicate_id in duplicates:
+      ctx.logger.info(f"Удалено изображение-дубликат с id {duplicate_id} (оригинал {original_id})")
 
-      return unique_images
+  return unique_images
 
 
-async def rem_duplicates(ctx):
+async def rem_duplicates(ctx, progress):
 
   ctx.logger.info(f"Поиск и удаление дубликатов - начало")
 
   # Поиск дубликатов и уникальных изображений
-  await find_duplicate_and_unique_images(ctx)
+  await find_duplicate_and_unique_images(ctx, progress)
 
   ctx.logger.info(f"Поиск и удаление дубликатов - завершено")
@@ -1,11 +1,14 @@
 import uvicorn, os
+from typing import Optional
 from fastapi import Request, FastAPI
 from modificator import rembcg
 from modificator import duplicates
 from modificator import pyramid
+from modificator import renditions
 from modificator.utils.utils import Context
 from modificator.utils import database
-from modificator.utils.models import PyramidParams
+from modificator.utils.models import PyramidParams, JobParams
+from modificator.utils.progress import JobProgress
 
 app = FastAPI()
 
@@ -15,6 +18,7 @@ ctx = Context()
 async def startup_event():
   """Вызывается при запуске приложения."""
   ctx.db_handle = await database.connect()
+  await database.migrate(ctx.db_handle)
   ctx.set_logger_handler(os.getenv("MODIFICATOR_LOG"))
 
 
@@ -23,12 +27,19 @@ async def shutdown_event():
   await database.disconnect(ctx.db_handle)
 
 @app.post("/rem_bg")
-async def rem_bg():
-  await rembcg.rem_background(ctx)
+async def rem_bg(request: Optional[JobParams] = None):
+  async with JobProgress(ctx, request.job_id if request else None) as progress:
+    await rembcg.rem_background(ctx, progress)
 
 @app.post("/rem_dup")
-async def rem_dup():
-  await duplicates.rem_duplicates(ctx)
+async def rem_dup(request: Optional[JobParams] = None):
+  async with JobProgress(ctx, request.job_id if request else None) as progress:
+    await duplicates.rem_duplicates(ctx, progress)
+
+@app.post("/renditions")
+async def renditions_backfill(request: Optional[JobParams] = None):
+  async with JobProgress(ctx, request.job_id if request else None) as progress:
+    await renditions.backfill_renditions(ctx, progress)
 
 @app.post("/pyramid")
 async def pyramid_handler(request: PyramidParams):
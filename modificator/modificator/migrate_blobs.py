@@ -0,0 +1,91 @@
+"""Перенос изображений scrapped_images, selected_images и pyramid_images между базой и хранилищем файлов.
+
+--to fs   данные file_data записываются в хранилище (BLOB_STORE_DIR) под хэшем содержимого,
+          в базе остается только file_hash. После переноса сервисы запускаются с BLOB_BACKEND=fs.
+--to db   обратный перенос данных из хранилища в базу.
+--gc      удаление файлов хранилища, на которые не ссылается ни одна строка (старше --gc-age секунд,
+          чтобы не удалить файл, строка для которого еще не зафиксирована).
+
+Перенос идет пакетами, каждый пакет фиксируется отдельно, поэтому прерванный запуск можно повторить.
+
+Запуск: poetry run migrate_blobs --to fs --batch-size 100
+"""
+import argparse, asyncio, hashlib, os, time
+from modificator.utils import database, blob_store
+
+async def to_fs(conn, store, table, batch_size):
+  loop = asyncio.get_running_loop()
+  moved, last_id = 0, 0
+  while True:
+    rows = await database.fetch_inline_blobs(conn, table, last_id, batch_size)
+    if not rows:
+      return moved
+    # Файлы записываются на диск до того, как строка перестанет хранить данные
+    records = await loop.run_in_executor(None, lambda: [(row["id"], store.put(row["file_data"], hashlib.sha256(row["file_data"]).hexdigest())) for row in rows])
+    async with conn.transaction():
+      await database.move_blobs_to_store(conn, table, records)
+    moved += len(records)
+    last_id = rows[-1]["id"]
+    print(f"{table}: перенесено в хранилище {moved}")
+
+async def to_db(conn, store, table, batch_size):
+  loop = asyncio.get_running_loop()
+  moved, last_id = 0, 0
+  while True:
+    rows = await database.fetch_stored_blobs(conn, table, last_id, batch_size)
+    if not rows:
+      return moved
+    blobs = await loop.run_in_executor(None, lambda: [(row["id"], row["file_hash"], store.get(row["file_hash"])) for row in rows])
+    records = []
+    for image_id, file_hash, data in blobs:
+      if data is None:
+        print(f"{table}: нет файла {file_hash} для строки {image_id}, пропускаем")
+      else:
+        records.append((image_id, bytes(data)))
+    async with conn.transaction():
+      await database.restore_blobs(conn, table, records)
+    moved += len(records)
+    last_id = rows[-1]["id"]
+    print(f"{table}: возвращено в базу {moved}")
+
+async def collect_garbage(conn, store, age):
+  referenced = await database.fetch_blob_hashes(conn)
+  deadline = time.time() - age
+  deleted = 0
+  for file_hash, mtime in list(store.hashes()):
+    if file_hash not in referenced and mtime < deadline:
+      store.delete(file_hash)
+      deleted += 1
+  print(f"Удалено файлов без ссылок: {deleted}")
+
+async def run(args):
+  store = blob_store.BlobStore(args.store_dir)
+  pool = await database.connect()
+  try:
+    async with pool.acquire() as conn:
+      if args.to is not None:
+        migrate = to_fs if args.to == "fs" else to_db
+        for table in args.tables:
+          started = time.perf_counter()
+          moved = await migrate(conn, store, table, args.batch_size)
+          print(f"{table}: {moved} изображений за {time.perf_counter() - started:.1f} с")
+      if args.gc:
+        await collect_garbage(conn, store, args.gc_age)
+  finally:
+    await database.disconnect(pool)
+
+def main():
+  parser = argparse.ArgumentParser(description="Перенос изображений между базой и хранилищем файлов")
+  parser.add_argument("--to", choices=["fs", "db"])
+  parser.add_argument("--tables", nargs="+", default=list(database.BLOB_TABLES), choices=database.BLOB_TABLES)
+  parser.add_argument("--batch-size", type=int, default=100)
+  parser.add_argument("--store-dir", default=os.getenv("BLOB_STORE_DIR", "/data/blobs"))
+  parser.add_argument("--gc", action="store_true")
+  parser.add_argument("--gc-age", type=int, default=3600)
+  args = parser.parse_args()
+  if args.to is None and not args.gc:
+    parser.error("укажите --to или --gc")
+  asyncio.run(run(args))
+
+if __name__ == "__main__":
+  main()
@@ -2,18 +2,20 @@ import cv2, asyncpg, logging
 import numpy as np
 from modificator.utils import database 
 
-async def fetch_image(ctx, image_id):
+async def fetch_images(ctx, image_ids):
+  # Данные нескольких изображений одним запросом: id -> file_data (None, если изображение не найдено)
   try:
     async with ctx.db_handle.acquire() as conn:
-      async with conn.transaction():
-        image_data = await database.selected_image_by_id(conn, image_id)
-        if image_data is None:
-          ctx.logger.error(f"Изображение не найдено ID: {image_id}")
-        else:
-          ctx.logger.info(f"Изображение найдено с ID: {image_id}")
-        return image_data
+      rows = await database.fetch_many_by_ids(conn, image_ids)
+    found = {row["id"]: row["file_data"] for row in rows}
+    for image_id in image_ids:
+      if image_id in found:
+        ctx.logger.info(f"Изображение найдено с ID: {image_id}")
+      else:
+        ctx.logger.error(f"Изображение не найдено ID: {image_id}")
+    return {image_id: found.get(image_id) for image_id in image_ids}
   except Exception as e:
-    ctx.logger.error(f"Ошибка поиска изображения {image_id}: {e}")
+    ctx.logger.error(f"Ошибка поиска изображений {image_ids}: {e}")
     raise
 
 async def save_image(ctx, file_data, img1_id, img2_id):
@@ -47,8 +49,8 @@ async def reconstruct_image_from_pyramid(laplacian_pyramid):
 
 async def pyramid_start(img1_id, img2_id, ctx):
   
-  img1_data = await fetch_image(ctx, img1_id)
-  img2_data = await fetch_image(ctx, img2_id)
+  images = await fetch_images(ctx, [img1_id, img2_id])
+  img1_data, img2_data = images[img1_id], images[img2_id]
 
   if img1_data is None or img2_data is None:
     ctx.logger.error("Не удалось загрузить данные изображения.")
@@ -1,65 +1,91 @@
-import asyncio, asyncpg, logging, io
-from rembg import remove
+import asyncio, io, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from rembg import remove, new_session
 from PIL import Image
 from modificator.utils import database
+from modificator import renditions
 
-async def process_image(ctx, row):
-  file_data            = row["file_data"]
-  file_name            = row["file_name"]
-  fk_scrapped_image_id = row["id"]
-  
-  # Удаление фона
-  try:
-    processed_data = await remove_background(file_data)
-  except Exception as e:
-    ctx.logger.error(f"Не удалось удалить фон из {file_name}: {e}")
-    return
+# Сессия rembg создается один раз на поток-воркер
+_worker_state = threading.local()
 
-  # Сохранение обработанного изображения в новой таблице selected_images
-  ctx.logger.info(f"Обработка изображения: {file_name}")
-  async with ctx.db_handle.acquire() as conn:
-    async with conn.transaction():
-      try:
-        await database.insert_selected_image(conn, fk_scrapped_image_id, processed_data)
-        ctx.logger.info(f"Фон удален для {file_name}")
-      except asyncpg.exceptions.UniqueViolationError:
-        ctx.logger.error(f"Обнаружен дубликат хэша файла для {file_name}, пропуск...")
-      except Exception as e:
-        ctx.logger.error(f"Не удалось вставить данные для {file_name}: {e}")
+def get_session():
+  session = getattr(_worker_state, "session", None)
+  if session is None:
+    session = _worker_state.session = new_session(os.getenv("REMBG_MODEL", "u2net"))
+  return session
 
-async def remove_background(file_data):
+def remove_background(file_data):
   # Преобразование байтов в объект PIL Image
-  image = Image.open(io.BytesIO(file_data))
-  # Удаление фона
-  processed_image = await asyncio.to_thread(remove, image)
-  # Преобразование обработанного изображения в байты
-  processed_data = image_to_bytes(processed_image)
-  return processed_data
+  with Image.open(io.BytesIO(file_data)) as image:
+    # Удаление фона
+    processed_image = remove(image, session=get_session())
+  # Преобразование обработанного изображения в байты и уменьшенные копии для finder
+  return image_to_bytes(processed_image), renditions.make_renditions(processed_image)
 
 def image_to_bytes(image):
   with io.BytesIO() as buffer:
     image.save(buffer, format='PNG')
     return buffer.getvalue()
 
-async def process_images(ctx):
-  async with ctx.db_handle.acquire() as conn:
-    async with conn.transaction():
-      scrapped_images = await database.fetch_all_scrapped_images_images(conn)
-      for row in scrapped_images:
-        try:
-          async with conn.transaction():
-            await process_image(ctx, row)
-        except asyncpg.exceptions.UniqueViolationError:
-          ctx.logger.error(f"Обнаружен дубликат внешнего ключа изображения для name: {row['file_name']} id: {row['id']}, пропуск...")
-        except Exception as e:
-          ctx.logger.error(f"Ошибка при обработке изображения {row['file_name']}: {e}")
+async def process_image(ctx, pool, row):
+  # Удаление фона на пуле воркеров
+  try:
+    loop = asyncio.get_running_loop()
+    processed_data, image_renditions = await loop.run_in_executor(pool, remove_background, row["file_data"])
+    ctx.logger.info(f"Фон удален для {row['file_name']}")
+    return row["id"], processed_data, image_renditions
+  except Exception as e:
+    ctx.logger.error(f"Не удалось удалить фон из {row['file_name']}: {e}")
+    return None
+
+async def save_batch(ctx, results):
+  # Сохранение пакета обработанных изображений и их уменьшенных копий одной транзакцией
+  results = [result for result in results if result is not None]
+  if results:
+    records = [(scrapped_image_id, data) for scrapped_image_id, data, _ in results]
+    image_renditions = {scrapped_image_id: sizes for scrapped_image_id, _, sizes in results}
+    async with ctx.db_handle.acquire() as conn:
+      await database.insert_selected_images(conn, records, image_renditions)
+  return len(results)
+
+async def process_images(ctx, progress):
+  # Обрабатываются только изображения без записи в selected_images, результаты фиксируются пакетами,
+  # поэтому прерванный запуск продолжается с того места, где остановился
+  workers = int(os.getenv("REMBG_WORKERS", os.cpu_count()))
+  batch_size = int(os.getenv("REMBG_BATCH_SIZE", 16))
+  processed = 0
+  results = []
+  pending = set()
+  started = time.perf_counter()
+
+  with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rembg") as pool:
+    async for row in database.iterate_unprocessed_scrapped_images(ctx.db_handle):
+      # Ограничение числа изображений в обработке
+      if len(pending) >= 2 * workers:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        results.extend(task.result() for task in done)
+      if len(results) >= batch_size:
+        processed += await save_batch(ctx, results)
+        results = []
+        await progress.update(processed)
+      pending.add(asyncio.ensure_future(process_image(ctx, pool, row)))
+
+    if pending:
+      results.extend(await asyncio.gather(*pending))
+    processed += await save_batch(ctx, results)
+  await progress.update(processed, force=True)
+
+  elapsed = time.perf_counter() - started
+  if processed:
+    ctx.logger.info(f"Фон удален для {processed} изображений за {elapsed:.2f} с ({processed / elapsed:.1f} изобр./с)")
+  return processed
 
 
-async def rem_background(ctx):
+async def rem_background(ctx, progress):
   # Подключение к базе данных
   ctx.logger.info(f"Начат процесс удаления фона")
 
   # Выполнение обработки изображений асинхронно
-  await process_images(ctx)
+  await process_images(ctx, progress)
 
   ctx.logger.info(f"Процесс удаления фона завершен")
@@ -0,0 +1,70 @@
+import asyncio, io, os, time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from modificator.utils import database, constants
+
+def make_renditions(image):
+  # Уменьшенные копии изображения: меньшая сторона равна size, пропорции сохраняются, изображения меньше size
+  # не увеличиваются. PNG с минимальным сжатием - без потерь (сохраняется альфа-канал) и быстро декодируется
+  renditions = {}
+  for size in constants.RENDITION_SIZES:
+    scale = size / min(image.size)
+    rendition = image
+    if scale < 1:
+      rendition = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+    with io.BytesIO() as buffer:
+      rendition.save(buffer, format='PNG', compress_level=1)
+      renditions[size] = buffer.getvalue()
+  return renditions
+
+def renditions_from_bytes(file_data):
+  with Image.open(io.BytesIO(file_data)) as image:
+    image.load()
+    return make_renditions(image)
+
+async def render_row(ctx, pool, row):
+  try:
+    loop = asyncio.get_running_loop()
+    renditions = await loop.run_in_executor(pool, renditions_from_bytes, row["file_data"])
+    return [(row["id"], size, data) for size, data in renditions.items()]
+  except Exception as e:
+    ctx.logger.error(f"Не удалось построить уменьшенные копии изображения {row['id']}: {e}")
+    return []
+
+async def save_batch(ctx, results):
+  records = [record for result in results for record in result]
+  if records:
+    async with ctx.db_handle.acquire() as conn:
+      await database.insert_renditions(conn, records)
+  return sum(1 for result in results if result)
+
+async def backfill_renditions(ctx, progress):
+  # Уменьшенные копии для строк selected_images, добавленных до появления image_renditions.
+  # Строки читаются потоком, копии строятся на пуле потоков и сохраняются пакетами
+  workers = int(os.getenv("REMBG_WORKERS", os.cpu_count()))
+  batch_size = int(os.getenv("REMBG_BATCH_SIZE", 16))
+  rendered = 0
+  results = []
+  pending = set()
+  started = time.perf_counter()
+  ctx.logger.info("Построение уменьшенных копий изображений - начало")
+
+  with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="renditions") as pool:
+    async for row in database.iterate_selected_images_without_renditions(ctx.db_handle, constants.RENDITION_SIZES):
+      if len(pending) >= 2 * workers:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        results.extend(task.result() for task in done)
+      if len(results) >= batch_size:
+        rendered += await save_batch(ctx, results)
+        results = []
+        await progress.update(rendered)
+      pending.add(asyncio.ensure_future(render_row(ctx, pool, row)))
+
+    if pending:
+      results.extend(await asyncio.gather(*pending))
+    rendered += await save_batch(ctx, results)
+  await progress.update(rendered, force=True)
+
+  elapsed = time.perf_counter() - started
+  ctx.logger.info(f"Построение уменьшенных копий изображений - завершено: {rendered} изображений за {elapsed:.2f} с")
+  return rendered
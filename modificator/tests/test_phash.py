@@ -0,0 +1,80 @@
+import io, random
+import numpy as np
+import pytest
+from PIL import Image
+from modificator.utils import phash
+
+def signed(value):
+  return value - (1 << 64) if value >= (1 << 63) else value
+
+def flip_bits(rng, value, count):
+  for bit in rng.sample(range(64), count):
+    value ^= 1 << bit
+  return value
+
+def clustered_rows(seed, clusters=40, size=8):
+  # Группы похожих хэшей (несколько измененных бит от общего) вперемешку, как строки scrapped_images по id
+  rng = random.Random(seed)
+  hashes = []
+  for _ in range(clusters):
+    base = rng.getrandbits(64)
+    hashes.extend(flip_bits(rng, base, rng.randint(0, 24)) for _ in range(rng.randint(1, size)))
+  rng.shuffle(hashes)
+  return [{"id": image_id, "phash": signed(value)} for image_id, value in enumerate(hashes, start=1)]
+
+def naive_split(rows, threshold):
+  # Попарное сравнение с каждым оставленным изображением
+  unique, duplicates = [], []
+  for row in rows:
+    if any(phash.hamming(row["phash"], kept["phash"]) < threshold for kept in unique):
+      duplicates.append(row["id"])
+    else:
+      unique.append(row)
+  return [row["id"] for row in unique], duplicates
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("threshold", [1, 4, 10, 16, 25])
+def test_split_duplicates_matches_naive(seed, threshold):
+  rows = clustered_rows(seed)
+  expected_unique, expected_duplicates = naive_split(rows, threshold)
+
+  unique, duplicates = phash.split_duplicates(rows, threshold)
+
+  assert unique == expected_unique
+  assert [duplicate_id for _, duplicate_id in duplicates] == expected_duplicates
+  hashes = {row["id"]: row["phash"] for row in rows}
+  for original_id, duplicate_id in duplicates:
+    # Оригинал оставлен раньше дубликата и действительно похож на него
+    assert original_id in unique and original_id < duplicate_id
+    assert phash.hamming(hashes[original_id], hashes[duplicate_id]) < threshold
+
+@pytest.mark.parametrize("threshold", [5, 12])
+def test_find_matches_naive_after_discard(threshold):
+  rng = random.Random(7)
+  rows = clustered_rows(7)
+  tree = phash.BKTree()
+  kept = []
+  for row in rows:
+    tree.add(row["phash"], row["id"])
+    kept.append(row)
+  for row in rng.sample(rows, len(rows) // 3):
+    tree.discard(row["phash"], row["id"])
+    kept.remove(row)
+
+  assert len(tree) == len(kept)
+  for _ in range(200):
+    query = signed(flip_bits(rng, rng.choice(rows)["phash"] & phash.HASH_MASK, rng.randint(0, 16)))
+    found = tree.find(query, threshold)
+    matches = {row["id"] for row in kept if phash.hamming(query, row["phash"]) < threshold}
+    assert (found is None) == (not matches)
+    assert found is None or found in matches
+
+def test_phash_int_is_signed_64_bit():
+  image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8))
+  buffer = io.BytesIO()
+  image.save(buffer, format="PNG")
+
+  value = phash.phash_int(buffer.getvalue())
+
+  assert -(1 << 63) <= value < (1 << 63)
+  assert phash.hamming(value, value) == 0
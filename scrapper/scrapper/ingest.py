@@ -0,0 +1,73 @@
+import asyncio, os
+from scrapper.utils import database
+
+class IngestBuffer:
+  """Буфер загруженных изображений, сбрасываемый в базу одним многострочным INSERT по размеру или по времени.
+  Вставляется не больше limit изображений за обход, поэтому max_images соблюдается точно."""
+
+  def __init__(self, ctx, limit):
+    self.ctx = ctx
+    self.limit = limit
+    self.saved = 0
+    self.flush_size = int(os.getenv("INGEST_FLUSH_SIZE", 50))
+    self.flush_interval = float(os.getenv("INGEST_FLUSH_INTERVAL", 1.0))
+    self._items = []
+    self._lock = asyncio.Lock()
+    self._timer = None
+
+  def full(self):
+    return self.saved >= self.limit
+
+  def start(self):
+    self._timer = asyncio.create_task(self._flush_periodically())
+
+  async def close(self):
+    if self._timer is not None:
+      self._timer.cancel()
+    await self.flush()
+
+  async def add(self, filename, file_hash, file_content, phash):
+    """Поставить изображение в очередь на вставку. Возвращает True, если изображение сохранено в базе,
+    False - если изображение с таким хэшом уже есть, None - если изображение не сохранялось (достигнут limit или ошибка)."""
+    if self.full():
+      return None
+    future = asyncio.get_running_loop().create_future()
+    self._items.append(((filename, file_hash, file_content, phash), future))
+    if len(self._items) >= self.flush_size:
+      await self.flush()
+    return await future
+
+  async def _flush_periodically(self):
+    while True:
+      await asyncio.sleep(self.flush_interval)
+      await self.flush()
+
+  async def flush(self):
+    async with self._lock:
+      items, self._items = self._items, []
+      if not items:
+        return
+      try:
+        remaining = items
+        while remaining and not self.full():
+          # Вставляется не больше оставшегося до limit числа изображений
+          count = self.limit - self.saved
+          chunk, remaining = remaining[:count], remaining[count:]
+          async with self.ctx.db_handle.acquire() as conn:
+            inserted = set(await database.insert_scrapped_images(conn, [record for record, _ in chunk]))
+          for (_, file_hash, _, _), future in chunk:
+            saved = file_hash in inserted
+            # Повтор хэша внутри пакета считается дубликатом
+            inserted.discard(file_hash)
+            future.set_result(saved)
+            if saved:
+              self.saved += 1
+            else:
+              self.ctx.logger.error(f"Изображение с хэшом {file_hash} уже существует, пропускаем...")
+      except Exception as e:
+        self.ctx.logger.error(f"Ошибка при сохранении пакета изображений: {e}")
+      finally:
+        # Изображения сверх limit и изображения из пакета с ошибкой не сохранялись
+        for _, future in items:
+          if not future.done():
+            future.set_result(None)
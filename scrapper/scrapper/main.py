@@ -4,6 +4,7 @@ from scrapper.utils.models import ScraperParams
 from scrapper import scrapper
 from scrapper.utils.utils import Context
 from scrapper.utils import database
+from scrapper.utils.progress import JobProgress
 
 app = FastAPI()
 
@@ -13,6 +14,9 @@ ctx = Context()
 async def startup_event():
   """Вызывается при запуске приложения."""
   ctx.db_handle = await database.connect()
+  await database.migrate(ctx.db_handle)
+  # Один индекс почти-дубликатов на сервис, общий для одновременных обходов
+  ctx.phash_index = await scrapper.load_phash_index(ctx)
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -21,7 +25,8 @@ async def shutdown_event():
 @app.post("/start")
 async def start(request: ScraperParams):
   ctx.set_logger_handler(os.getenv("SCRAPPER_LOG"))
-  await scrapper.scrap(request.max_images, request.start_url, ctx)
+  async with JobProgress(ctx, request.job_id) as progress:
+    await scrapper.scrap(request.max_images, request.start_url, ctx, progress)
 
 def loader():
   """Launched with `poetry run start`"""
@@ -1,85 +1,206 @@
-import asyncio, uuid, asyncpg, httpx, hashlib, os
+import asyncio, uuid, httpx, hashlib, os
 from bs4 import BeautifulSoup
-from urllib.parse import urljoin
-from scrapper.utils import database
+from urllib.parse import urljoin, urlsplit
+from scrapper.utils import database, phash
+from scrapper.ingest import IngestBuffer
 from fastapi import status
 
-async def fetch(url, ctx):
+def create_client():
+  # Один клиент на весь обход: соединения переиспользуются (keep-alive) вместо нового TCP/TLS на каждый запрос
+  limits = httpx.Limits(
+    max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", 20)),
+    max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", 20)),
+  )
+  return httpx.AsyncClient(timeout=int(os.getenv("TIMEOUT")), limits=limits)
+
+class Crawl:
+  # Состояние одного обхода (/start): клиент HTTP, семафоры хостов, состояние url прошлых обходов
+  # и буфер вставки. Одновременные обходы не разделяют это состояние, поэтому завершение одного
+  # не закрывает клиент и не сбрасывает буфер другого. Индекс почти-дубликатов (ctx.phash_index) общий
+  # для всех обходов сервиса: изображение, зарезервированное одним обходом, видно и остальным
+  def __init__(self, ctx, http_client, crawl_state, max_images):
+    self.db_handle = ctx.db_handle
+    self.logger = ctx.logger
+    self.http_client = http_client
+    self.host_semaphores = {}
+    self.phash_index = ctx.phash_index
+    self.phash_threshold = int(os.getenv("THRESHOLD"))
+    self.crawl_state = crawl_state
+    self.crawl_updates = []
+    self.ingest_buffer = IngestBuffer(self, max_images)
+
+def host_semaphore(url, crawl):
+  # Ограничение числа одновременных запросов к одному хосту
+  host = urlsplit(url).netloc
+  if host not in crawl.host_semaphores:
+    crawl.host_semaphores[host] = asyncio.Semaphore(int(os.getenv("HTTP_HOST_CONCURRENCY", 8)))
+  return crawl.host_semaphores[host]
+
+async def fetch(url, crawl, headers=None):
   try:
-    async with httpx.AsyncClient(timeout=int(os.getenv("TIMEOUT"))) as client:
-      response = await client.get(url)
-      return response.content
-  except httpx.ReadTimeout:
-    ctx.logger.error(f"Ошибка тайм-аута при получении {url}")
+    async with host_semaphore(url, crawl):
+      return await crawl.http_client.get(url, headers=headers)
+  except httpx.TimeoutException:
+    crawl.logger.error(f"Ошибка тайм-аута при получении {url}")
+
+def conditional_headers(url, crawl):
+  # Условный запрос по ETag и Last-Modified, сохраненным при прошлом обходе
+  state = crawl.crawl_state.get(url)
+  headers = {}
+  if state is not None and state["etag"]:
+    headers["If-None-Match"] = state["etag"]
+  if state is not None and state["last_modified"]:
+    headers["If-Modified-Since"] = state["last_modified"]
+  return headers
+
+def remember_url(url, file_hash, response, crawl):
+  # Запоминаем url, чтобы при следующих обходах не загружать его повторно
+  record = {"file_hash": file_hash, "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+  crawl.crawl_state[url] = record
+  crawl.crawl_updates.append((url, record["file_hash"], record["etag"], record["last_modified"]))
+
+async def flush_crawl_state(crawl):
+  if crawl.crawl_updates:
+    updates, crawl.crawl_updates = crawl.crawl_updates, []
+    async with crawl.db_handle.acquire() as conn:
+      await database.upsert_crawl_state(conn, updates)
+
+async def load_crawl_state(ctx):
+  async with ctx.db_handle.acquire() as conn:
+    rows = await database.fetch_crawl_state(conn)
+  crawl_state = {row["url"]: {"file_hash": row["file_hash"], "etag": row["etag"], "last_modified": row["last_modified"]} for row in rows}
+  ctx.logger.info(f"Загружено состояние прошлых обходов: {len(crawl_state)} url")
+  return crawl_state
 
-async def parse_and_save_images(catalog_divs, base_url, ctx):
-  tasks = []
+def parse_image_urls(html, base_url):
+  soup = BeautifulSoup(html, 'html.parser')
+  catalog_divs = soup.find_all('div', class_='grid__catalog')
 
+  img_urls = []
   for catalog_div in catalog_divs:
     img_tags = catalog_div.find_all('img', class_='x-product-card__pic-img')
     for img_tag in img_tags:
-      img_url = urljoin(base_url, img_tag['src'])
-      tasks.append(save_image(img_url, ctx))
+      img_urls.append(urljoin(base_url, img_tag['src']))
+  return img_urls
+
+async def fetch_page_image_urls(start_url, page, crawl):
+  # Загрузка и разбор страницы каталога, разбор HTML выполняется вне цикла событий.
+  # Возвращает url страницы, ответ и список url изображений (None - страница не изменилась с прошлого обхода)
+  url = f"{start_url}page={page}"
+  response = await fetch(url, crawl, conditional_headers(url, crawl))
+  if response is None:
+    return url, None, []
+  if response.status_code == status.HTTP_304_NOT_MODIFIED:
+    crawl.logger.info(f"Страница {url} не изменилась с прошлого обхода, пропускаем")
+    return url, response, None
+  return url, response, await asyncio.to_thread(parse_image_urls, response.content, start_url)
+
+async def download_image(url, crawl):
+  try:
+    async with host_semaphore(url, crawl):
+      response = await crawl.http_client.get(url)
+  except httpx.HTTPError as e:
+    crawl.logger.error(f"Ошибка соединения при загрузке изображения {url}: {e}")
+    return None  # Ошибка соединения
+
+  if response.status_code != status.HTTP_200_OK:
+    crawl.logger.error(f"Не удалось загрузить изображение {url}: код состояния {response.status_code}")
+    return None  # Не удалось загрузить изображение
+  return response
+
+async def save_image(url, crawl):
+  if url in crawl.crawl_state:
+    # Изображение уже загружалось при прошлом обходе
+    return False
+
+  response = await download_image(url, crawl)
+  if response is None:
+    return False
 
-  await asyncio.gather(*tasks)
+  content_type = response.headers['Content-Type'].split('/')[-1]
+  filename = str(uuid.uuid4()) + '.' + content_type
+  file_content = response.content
 
-async def save_image(url, ctx):
+  # Рассчитываем хэш содержимого файла
+  file_hash = hashlib.sha256(file_content).hexdigest()
+
+  # Перцептивный хэш для отсева почти-дубликатов до вставки в базу
   try:
-    async with httpx.AsyncClient() as client:
-      response = await client.get(url, timeout=int(os.getenv("TIMEOUT")))
-      if response.status_code == status.HTTP_200_OK:
-        content_type = response.headers['Content-Type'].split('/')[-1]
-        filename = str(uuid.uuid4()) + '.' + content_type
-        file_content = response.content
-
-        # Рассчитываем хэш содержимого файла
-        file_hash = hashlib.sha256(file_content).hexdigest()
-
-        async with ctx.db_handle.acquire() as conn:
-          try:
-            # Вставляем изображение в базу данных
-            await database.insert_scrapped_image(conn, filename, file_hash, file_content)
-            
-            ctx.logger.info(f"Изображение сохранено: {filename}")
-            return True  # Успешно вставлено в базу данных
-          except asyncpg.exceptions.UniqueViolationError:
-            ctx.logger.error(f"Изображение с хэшом {file_hash} уже существует, пропускаем...")
-            return False  # Дубликат изображения, не вставляем
-      else:
-        ctx.logger.error(f"Не удалось загрузить изображение {url}: код состояния {response.status_code}")
-        return False  # Не удалось загрузить изображение
-  except httpx.ConnectError as e:
-    ctx.logger.error(f"Ошибка соединения при загрузке изображения {url}: {e}")
-    return False  # Ошибка соединения
-
-async def main(start_url, max_images, ctx):
+    img_hash = await asyncio.to_thread(phash.phash_int, file_content)
+  except Exception as e:
+    crawl.logger.error(f"Не удалось посчитать перцептивный хэш изображения {url}: {e}")
+    img_hash = None
+
+  if img_hash is not None:
+    original = crawl.phash_index.find_or_add(img_hash, file_hash, crawl.phash_threshold)
+    if original is not None:
+      crawl.logger.info(f"Изображение {url} почти совпадает с уже сохраненным ({original}), пропускаем...")
+      remember_url(url, file_hash, response, crawl)
+      return False  # Почти-дубликат, не вставляем
+
+  # Вставка в базу выполняется пакетами через буфер
+  saved = await crawl.ingest_buffer.add(filename, file_hash, file_content, img_hash)
+  if saved is not None:
+    remember_url(url, file_hash, response, crawl)
+  if saved:
+    crawl.logger.info(f"Изображение сохранено: {filename}")
+  elif img_hash is not None:
+    # Изображение не попало в базу - снимаем его хэш с индекса
+    crawl.phash_index.discard(img_hash, file_hash)
+  return bool(saved)
+
+async def main(start_url, max_images, crawl, progress):
   images_saved = 0
   page = 1
+  crawl.ingest_buffer.start()
+
+  # Следующая страница каталога загружается и разбирается, пока скачиваются изображения текущей
+  next_page = asyncio.create_task(fetch_page_image_urls(start_url, page, crawl))
+  try:
+    while images_saved < max_images:
+      page_url, page_response, img_urls = await next_page
+
+      if img_urls is not None and not img_urls:
+        crawl.logger.error(f"Не удалось загрузить {max_images}, недостаточно информации на сайте по данной ссылке")
+        break
+
+      page += 1
+      next_page = asyncio.create_task(fetch_page_image_urls(start_url, page, crawl))
+      if img_urls is None:
+        # Страница не изменилась, все ее изображения уже обработаны
+        continue
+
+      results = await asyncio.gather(*(save_image(img_url, crawl) for img_url in img_urls))
+      # Подсчет успешно вставленных изображений по результатам сброса буфера
+      images_saved += sum(results)
+      await progress.update(images_saved, max_images)
+
+      # Валидаторы страницы сохраняются, только если обработаны все ее изображения
+      if all(img_url in crawl.crawl_state for img_url in img_urls):
+        remember_url(page_url, None, page_response, crawl)
+      await flush_crawl_state(crawl)
+  finally:
+    next_page.cancel()
+    await crawl.ingest_buffer.close()
+    await flush_crawl_state(crawl)
+    await progress.done()
+
+  crawl.logger.info(f"Сохранили требуемое количество изображений: {images_saved}")
+
+
+async def load_phash_index(ctx):
+  # Индекс почти-дубликатов по перцептивным хэшам уже сохраненных изображений, загружается при запуске
+  # сервиса и дальше пополняется обходами
+  index = phash.BKTree()
+  async with ctx.db_handle.acquire() as conn:
+    rows = await database.fetch_scrapped_images_phashes(conn)
+  for row in rows:
+    index.add(row["phash"], f"id {row['id']}")
+  ctx.logger.info(f"Загружен индекс почти-дубликатов: {len(index)} хэшей")
+  return index
 
-  while images_saved < max_images:
-    url = f"{start_url}page={page}"
-    html = await fetch(url, ctx)
-    soup = BeautifulSoup(html, 'html.parser')
-    catalog_divs = soup.find_all('div', class_='grid__catalog')
-
-    if not catalog_divs:
-      ctx.logger.error(f"Не удалось загрузить {max_images}, недостаточно информации на сайте по данной ссылке")
-      break
-
-    tasks = []
-    for catalog_div in catalog_divs:
-      img_tags = catalog_div.find_all('img', class_='x-product-card__pic-img')
-      for img_tag in img_tags:
-        img_url = urljoin(start_url, img_tag['src'])
-        tasks.append(save_image(img_url, ctx))
-
-    results = await asyncio.gather(*tasks)
-    page += 1
-    # Подсчет успешно вставленных изображений
-    images_saved += sum(results)
-   
-  ctx.logger.info(f"Сохранили требуемое количество изображений: {images_saved}")
-
-
-async def scrap(max_images, start_url, ctx):
-  await main(start_url, max_images, ctx)
+async def scrap(max_images, start_url, ctx, progress):
+  crawl_state = await load_crawl_state(ctx)
+  async with create_client() as client:
+    crawl = Crawl(ctx, client, crawl_state, max_images)
+    await main(start_url, max_images, crawl, progress)
@@ -0,0 +1,69 @@
+import functools, hashlib, mmap, os, tempfile
+
+class BlobStore:
+  # Файлы изображений в локальном каталоге, адресуемые хэшем содержимого (sha256):
+  # root/ab/cd/abcd..., два уровня каталогов по первым символам хэша, чтобы в одном каталоге
+  # не было миллионов файлов. Одинаковое содержимое хранится один раз, файл после записи не меняется
+  def __init__(self, root):
+    self.root = root
+
+  def path(self, file_hash):
+    return os.path.join(self.root, file_hash[:2], file_hash[2:4], file_hash)
+
+  def put(self, data, file_hash=None):
+    """Записать данные, если файла с таким хэшем еще нет. Возвращает хэш содержимого.
+    Файл пишется во временный и атомарно переименовывается, поэтому читатели не видят недописанных файлов."""
+    file_hash = file_hash or hashlib.sha256(data).hexdigest()
+    path = self.path(file_hash)
+    if os.path.exists(path):
+      return file_hash
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+      with os.fdopen(fd, "wb") as f:
+        f.write(data)
+        f.flush()
+        # Строка в базе ссылается на файл только после того, как он записан на диск
+        os.fsync(f.fileno())
+      os.replace(tmp_path, path)
+    except BaseException:
+      if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+      raise
+    return file_hash
+
+  def get(self, file_hash):
+    """Содержимое файла как memoryview над mmap (без копирования) или None, если файла нет.
+    Страницы читаются с диска по мере обращения и остаются в кэше страниц ОС для всех процессов.
+    Отображение держит файл открытым, пока на него есть ссылки: долгоживущие копии (кэши) хранят bytes."""
+    try:
+      with open(self.path(file_hash), "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+          return b""
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except FileNotFoundError:
+      return None
+
+  def delete(self, file_hash):
+    try:
+      os.unlink(self.path(file_hash))
+    except FileNotFoundError:
+      pass
+
+  def hashes(self):
+    """Хэши и время изменения всех файлов хранилища."""
+    for directory, _, files in os.walk(self.root):
+      for name in files:
+        if not name.startswith(".tmp-"):
+          yield name, os.path.getmtime(os.path.join(directory, name))
+
+@functools.lru_cache(maxsize=None)
+def _open(root):
+  return BlobStore(root)
+
+def from_env():
+  """Хранилище файлов при BLOB_BACKEND=fs (каталог BLOB_STORE_DIR), иначе None - изображения хранятся в базе."""
+  if os.getenv("BLOB_BACKEND", "db") != "fs":
+    return None
+  return _open(os.getenv("BLOB_STORE_DIR", "/data/blobs"))
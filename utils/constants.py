@@ -7,4 +7,15 @@ STD = [0.229, 0.224, 0.225]  # Стандартные отклонения дл
 
 SIZE_256 = 256
 
-SIZE_224 = 224
\ No newline at end of file
+SIZE_224 = 224
+
+CLASSIFY_MODEL_VERSION = 'resnet18-classes-v1'  # Версия классификатора в selected_images.predicted_class_version
+
+PHOTO_MODEL_VERSION = 'resnet50-imagenet-v2'  # Версия эмбеддингов ResNet50 в таблице image_features
+
+CLIP_MODEL_VERSION = 'clip-vit-b32-v2'  # Версия нормированных признаков CLIP в таблице image_features
+
+HSV_FEATURE_VERSION = 'hsv-32x32x32-sparse-v1'  # Версия HSV гистограмм в таблице image_features
+
+LAB_HIST_FEATURE_VERSION = 'lab-ab-hist-32-v2'  # Версия гистограмм a/b (ciedge2000) в таблице image_features
+RENDITION_SIZES = [SIZE_256, SIZE_224]  # Размеры (меньшая сторона) уменьшенных копий selected_images в таблице image_renditions
@@ -1,9 +1,11 @@
-import asyncpg, os
+import asyncio, asyncpg, json, os
+from . import blob_store
 
 async def connect():
   try:
     # Создание пула соединений к базе данных
-    pool = await asyncpg.create_pool(os.getenv("DATABASE_URL"))
+    # Подготовленные запросы кэшируются на каждом соединении пула (DB_STATEMENT_CACHE_SIZE)
+    pool = await asyncpg.create_pool(os.getenv("DATABASE_URL"), statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100)))
       
   except Exception as e:
     # Обработка ошибок подключения к базе данных
@@ -11,49 +13,366 @@ async def connect():
   
   return pool
 
+# Ключ advisory-блокировки: сервисы, запущенные одновременно, обновляют схему по очереди
+MIGRATION_LOCK = 7_001_001
+
+async def migrate(pool):
+  """Применить utils/migrations.sql: добавить в существующую базу таблицы, столбцы и индексы,
+  появившиеся после ее создания. Шаги повторяемы, поэтому выполняются при каждом запуске сервиса."""
+  with open(os.path.join(os.path.dirname(__file__), "migrations.sql")) as f:
+    script = f.read()
+  async with pool.acquire() as conn:
+    async with conn.transaction():
+      await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK)
+      await conn.execute(script)
+
 async def disconnect(conn):
   """Закрываем соединение с базой данных."""
   await conn.close()
 
-async def insert_scrapped_image(conn, filename, file_hash, file_content):
-  """Вставить информацию о скрапленном изображении в базу данных."""
-  await conn.execute("""
-    INSERT INTO public.scrapped_images (file_name, file_hash, file_data)
-    VALUES ($1, $2, $3)
-  """, filename, file_hash, file_content)
+def resolve_blob(row):
+  """Строка с file_data из хранилища файлов, если в базе у нее хранится только file_hash (BLOB_BACKEND=fs).
+  Остальные строки возвращаются без изменений."""
+  if "file_data" not in row.keys() or row["file_data"] is not None or row.get("file_hash") is None:
+    return row
+  store = blob_store.from_env()
+  if store is None:
+    return row
+  resolved = dict(row)
+  resolved["file_data"] = store.get(row["file_hash"])
+  return resolved
 
-async def fetch_all_scrapped_images_images(conn):
-  async with conn.transaction():
-    return await conn.fetch("SELECT id, file_name, file_hash, file_data FROM scrapped_images")
+async def resolve_blobs(rows):
+  """resolve_blob для списка строк, файлы открываются вне цикла событий."""
+  if not rows or blob_store.from_env() is None:
+    return rows
+  return await asyncio.get_running_loop().run_in_executor(None, lambda: [resolve_blob(row) for row in rows])
 
-async def fetch_all_rows_without_target(conn, target_id):
-  async with conn.transaction():
-    return await conn.fetch("SELECT id, file_data FROM selected_images WHERE id != $1", target_id)
+async def store_blobs(datas):
+  """Записать данные в хранилище файлов. Возвращает их хэши или None, если включено хранение в базе."""
+  store = blob_store.from_env()
+  if store is None:
+    return None
+  return await asyncio.get_running_loop().run_in_executor(None, lambda: [store.put(data) for data in datas])
+
+async def iterate(pool, query, *args, page_size=None):
+  """Построчное чтение результата запроса страницами по id (keyset): запрос получает последний
+  прочитанный id в $1 и размер страницы в $2 и должен содержать "id > $1 ORDER BY id LIMIT $2",
+  остальные параметры - $3 и далее. В памяти одновременно не больше page_size строк (DB_PREFETCH).
+  Соединение берется из пула только на время чтения страницы: обработка строк и запись результатов
+  через другие соединения пула не ждут, пока освободится соединение чтения."""
+  page_size = page_size or int(os.getenv("DB_PREFETCH", 50))
+  last_id = 0
+  while True:
+    async with pool.acquire() as conn:
+      rows = await conn.fetch(query, last_id, page_size, *args)
+    if not rows:
+      return
+    for row in await resolve_blobs(rows):
+      yield row
+    last_id = rows[-1]["id"]
+
+async def insert_scrapped_images(conn, records):
+  """Вставить пакет скрапленных изображений одним запросом, records - кортежи (file_name, file_hash, file_data, phash).
+  Изображения с уже существующим file_hash пропускаются, возвращаются хэши вставленных строк.
+  При BLOB_BACKEND=fs данные записываются в хранилище файлов, в базе остается только file_hash."""
+  file_names, file_hashes, file_datas, phashes = zip(*records)
+  if await store_blobs(file_datas) is not None:
+    file_datas = [None] * len(file_datas)
+  rows = await conn.fetch("""
+    INSERT INTO scrapped_images (file_name, file_hash, file_data, phash)
+    SELECT * FROM unnest($1::text[], $2::text[], $3::bytea[], $4::bigint[])
+    ON CONFLICT (file_hash) DO NOTHING
+    RETURNING file_hash
+  """, list(file_names), list(file_hashes), list(file_datas), list(phashes))
+  return [row["file_hash"] for row in rows]
+
+async def fetch_in_batches(conn, query, ids, *args, batch_size=None):
+  """Выполнить запрос с условием "= ANY($1)" для списка ids пакетами по batch_size (DB_ID_BATCH) id,
+  остальные параметры запроса - $2 и далее. Текст запроса не зависит от числа id, поэтому asyncpg
+  подготавливает его один раз на соединение и дальше выполняет из кэша подготовленных запросов."""
+  ids = list(ids)
+  if not ids:
+    return []
+  batch_size = batch_size or int(os.getenv("DB_ID_BATCH", 1000))
+  rows = []
+  for start in range(0, len(ids), batch_size):
+    rows.extend(await conn.fetch(query, ids[start:start + batch_size], *args))
+  return rows
 
 async def fetch_selected_images_ids(conn):
-  return await conn.fetch("SELECT id FROM selected_images")
+  return await conn.fetch("SELECT id FROM selected_images ORDER BY id")
+
+async def fetch_many_by_ids(conn, image_ids, with_data=True, batch_size=None):
+  """Изображения selected_images по списку id за один запрос на пакет: id, file_hash, predicted_class,
+  predicted_class_version и file_data, если with_data. Без with_data данные изображений не передаются.
+  Порядок строк не гарантируется."""
+  columns = "id, file_hash, predicted_class, predicted_class_version"
+  columns = f"{columns}, file_data" if with_data else columns
+  rows = await fetch_in_batches(conn, f"SELECT {columns} FROM selected_images WHERE id = ANY($1::int[])", image_ids, batch_size=batch_size)
+  return await resolve_blobs(rows) if with_data else rows
+
+async def backfill_selected_images_hashes(conn):
+  """Посчитать хэш содержимого для строк, добавленных до появления столбца file_hash."""
+  return await conn.execute("""
+    UPDATE selected_images SET file_hash = encode(sha256(file_data), 'hex') WHERE file_hash IS NULL
+  """)
+
+async def delete_duplicate_images(conn, duplicate_ids):
+  await conn.execute("DELETE FROM scrapped_images WHERE id = ANY($1::int[])", list(duplicate_ids))
 
-async def fetch_all_selected_images_id_data(conn):
-  return await conn.fetch("SELECT id, file_data FROM selected_images")
+def iterate_scrapped_images_without_phash(pool, page_size=None):
+  return iterate(pool, """
+    SELECT id, file_hash, file_data FROM scrapped_images WHERE phash IS NULL AND id > $1 ORDER BY id LIMIT $2
+  """, page_size=page_size)
 
-async def fetch_row_selected_image(conn, image_id):
-  query = "SELECT id, file_data FROM selected_images WHERE id = $1"
-  return await conn.fetchrow(query, image_id)
+async def update_phashes(conn, records):
+  """Сохранить перцептивные хэши, records - список пар (id, phash)."""
+  await conn.executemany("UPDATE scrapped_images SET phash = $2 WHERE id = $1", records)
 
-async def delete_duplicate_image(conn, duplicate_id):
-  await conn.execute("DELETE FROM scrapped_images WHERE id = $1", duplicate_id)
+async def fetch_scrapped_images_phashes(conn):
+  return await conn.fetch("SELECT id, phash FROM scrapped_images WHERE phash IS NOT NULL ORDER BY id")
 
 async def save_pyramid_image(conn, file_data, selected_image_id_1, selected_image_id_2):
-  insert_query = "INSERT INTO pyramid_images ( file_data, selected_image_id_1, selected_image_id_2) VALUES ($1, $2, $3)"
-  await conn.execute(insert_query, file_data, selected_image_id_1, selected_image_id_2)
+  file_hash = None
+  stored = await store_blobs([file_data])
+  if stored is not None:
+    file_data, file_hash = None, stored[0]
+  insert_query = """
+    INSERT INTO pyramid_images (file_data, file_hash, selected_image_id_1, selected_image_id_2)
+    VALUES ($1, COALESCE($2, encode(sha256($1), 'hex')), $3, $4)
+  """
+  await conn.execute(insert_query, file_data, file_hash, selected_image_id_1, selected_image_id_2)
 
-async def selected_image_by_id(conn, image_id):
+async def insert_selected_images(conn, records, renditions=None):
+  """Вставить пакет обработанных изображений одной транзакцией, records - список пар (scrapped_image_id, file_data).
+  renditions - уменьшенные копии: scrapped_image_id -> {size: data}, сохраняются для вставленных строк.
+  Возвращает список пар (id, scrapped_image_id) вставленных строк."""
+  scrapped_ids, file_datas = zip(*records)
+  file_hashes = await store_blobs(file_datas)
+  if file_hashes is None:
+    file_hashes = [None] * len(file_datas)
+  else:
+    file_datas = [None] * len(file_datas)
   async with conn.transaction():
-    return await conn.fetchval("SELECT file_data FROM selected_images WHERE id = $1", image_id)
+    rows = await conn.fetch("""
+      INSERT INTO selected_images (scrapped_image_id, file_data, file_hash)
+      SELECT scrapped_image_id, file_data, COALESCE(file_hash, encode(sha256(file_data), 'hex'))
+      FROM unnest($1::int[], $2::bytea[], $3::text[]) AS t(scrapped_image_id, file_data, file_hash)
+      ON CONFLICT (scrapped_image_id) DO NOTHING
+      RETURNING id, scrapped_image_id
+    """, list(scrapped_ids), list(file_datas), list(file_hashes))
+    if renditions:
+      await insert_renditions(conn, [
+        (row["id"], size, data)
+        for row in rows
+        for size, data in renditions.get(row["scrapped_image_id"], {}).items()
+      ])
+  return [(row["id"], row["scrapped_image_id"]) for row in rows]
+
+async def insert_renditions(conn, records):
+  """Сохранить уменьшенные копии изображений, records - кортежи (selected_image_id, size, data)."""
+  if records:
+    await conn.executemany("""
+      INSERT INTO image_renditions (selected_image_id, size, data)
+      VALUES ($1, $2, $3)
+      ON CONFLICT (selected_image_id, size) DO UPDATE SET data = EXCLUDED.data
+    """, records)
+
+def iterate_selected_images_without_renditions(pool, sizes, page_size=None):
+  """Изображения selected_images, у которых нет хотя бы одной из уменьшенных копий размеров sizes."""
+  return iterate(pool, """
+    SELECT s.id, s.file_hash, s.file_data FROM selected_images s
+    WHERE (SELECT count(*) FROM image_renditions r WHERE r.selected_image_id = s.id AND r.size = ANY($3::int[])) < cardinality($3::int[])
+      AND s.id > $1
+    ORDER BY s.id LIMIT $2
+  """, list(sizes), page_size=page_size)
+
+async def fetch_renditions(conn, image_ids, size):
+  """Уменьшенные копии размера size: строки (id, file_data); изображения без копии не возвращаются."""
+  return await fetch_in_batches(conn, """
+    SELECT selected_image_id AS id, data AS file_data FROM image_renditions
+    WHERE selected_image_id = ANY($1::int[]) AND size = $2
+  """, image_ids, size)
+
+def iterate_unprocessed_scrapped_images(pool, page_size=None):
+  """Скрапленные изображения, для которых еще нет записи в selected_images."""
+  return iterate(pool, """
+    SELECT s.id, s.file_name, s.file_hash, s.file_data FROM scrapped_images s
+    LEFT JOIN selected_images si ON si.scrapped_image_id = s.id
+    WHERE si.id IS NULL AND s.id > $1
+    ORDER BY s.id LIMIT $2
+  """, page_size=page_size)
+
+async def fetch_predicted_classes(conn, image_ids, model_version):
+  """Сохраненные предсказанные классы: строки (id, predicted_class), predicted_class - NULL,
+  если класс еще не считался версией классификатора model_version."""
+  return await fetch_in_batches(conn, """
+    SELECT id, CASE WHEN predicted_class_version = $2 THEN predicted_class END AS predicted_class
+    FROM selected_images WHERE id = ANY($1::int[])
+  """, image_ids, model_version)
+
+def iterate_selected_images_without_class(pool, model_version, image_ids=None, page_size=None):
+  """Изображения без класса, предсказанного версией классификатора model_version, все или только из image_ids."""
+  if image_ids is None:
+    return iterate(pool, """
+      SELECT id, file_hash FROM selected_images
+      WHERE predicted_class_version IS DISTINCT FROM $3 AND id > $1 ORDER BY id LIMIT $2
+    """, model_version, page_size=page_size)
+  return iterate(pool, """
+    SELECT id, file_hash FROM selected_images
+    WHERE predicted_class_version IS DISTINCT FROM $3 AND id = ANY($4::int[]) AND id > $1 ORDER BY id LIMIT $2
+  """, model_version, list(image_ids), page_size=page_size)
+
+async def update_predicted_classes(conn, records, model_version):
+  """Сохранить предсказанные классы версии классификатора model_version, records - пары (id, predicted_class)."""
+  await conn.executemany("UPDATE selected_images SET predicted_class = $2, predicted_class_version = $3 WHERE id = $1", [(image_id, label, model_version) for image_id, label in records])
+
+async def fetch_features(conn, model_version, image_ids=None):
+  """Получить сохраненные признаки (эмбеддинги) изображений для версии модели, опционально только для image_ids."""
+  if image_ids is None:
+    query = "SELECT selected_image_id, data FROM image_features WHERE model_version = $1 ORDER BY selected_image_id"
+    return await conn.fetch(query, model_version)
+  query = """
+    SELECT selected_image_id, data FROM image_features
+    WHERE selected_image_id = ANY($1::int[]) AND model_version = $2
+    ORDER BY selected_image_id
+  """
+  return await fetch_in_batches(conn, query, image_ids, model_version)
+
+def iterate_selected_images_without_features(pool, model_version, page_size=None):
+  """Изображения selected_images (id и хэш содержимого), для которых еще не посчитаны признаки данной версии модели."""
+  return iterate(pool, """
+    SELECT s.id, s.file_hash FROM selected_images s
+    LEFT JOIN image_features f ON f.selected_image_id = s.id AND f.model_version = $3
+    WHERE f.selected_image_id IS NULL AND s.id > $1
+    ORDER BY s.id LIMIT $2
+  """, model_version, page_size=page_size)
 
-async def insert_selected_image(conn, fk_scrapped_image_id, processed_data):
+async def upsert_features(conn, model_version, records):
+  """Сохранить признаки изображений, records - список пар (selected_image_id, data)."""
   insert_query = """
-    INSERT INTO selected_images (scrapped_image_id, file_data)
-    VALUES ($1, $2)
+    INSERT INTO image_features (selected_image_id, model_version, data)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (selected_image_id, model_version) DO UPDATE SET data = EXCLUDED.data
   """
-  await conn.execute(insert_query, fk_scrapped_image_id, processed_data)
\ No newline at end of file
+  await conn.executemany(insert_query, [(image_id, model_version, data) for image_id, data in records])
+
+async def delete_features(conn, model_version):
+  await conn.execute("DELETE FROM image_features WHERE model_version = $1", model_version)
+
+
+BLOB_TABLES = ("scrapped_images", "selected_images", "pyramid_images")
+
+def blob_table(table):
+  if table not in BLOB_TABLES:
+    raise ValueError(f"Таблица {table} не хранит изображения")
+  return table
+
+async def fetch_inline_blobs(conn, table, after_id, limit):
+  """Строки table с данными в базе (id > after_id, не больше limit): id, file_data."""
+  return await conn.fetch(f"""
+    SELECT id, file_data FROM {blob_table(table)} WHERE file_data IS NOT NULL AND id > $1 ORDER BY id LIMIT $2
+  """, after_id, limit)
+
+async def move_blobs_to_store(conn, table, records):
+  """Оставить в базе только хэш, records - пары (id, file_hash). Данные должны быть уже записаны в хранилище файлов."""
+  await conn.executemany(f"UPDATE {blob_table(table)} SET file_data = NULL, file_hash = $2 WHERE id = $1", records)
+
+async def fetch_stored_blobs(conn, table, after_id, limit):
+  """Строки table, данные которых находятся в хранилище файлов: id, file_hash."""
+  return await conn.fetch(f"""
+    SELECT id, file_hash FROM {blob_table(table)}
+    WHERE file_data IS NULL AND file_hash IS NOT NULL AND id > $1 ORDER BY id LIMIT $2
+  """, after_id, limit)
+
+async def restore_blobs(conn, table, records):
+  """Вернуть данные в базу, records - пары (id, file_data)."""
+  await conn.executemany(f"UPDATE {blob_table(table)} SET file_data = $2 WHERE id = $1", records)
+
+async def fetch_blob_hashes(conn):
+  """Хэши всех изображений, данные которых находятся в хранилище файлов."""
+  rows = await conn.fetch(" UNION ".join(f"SELECT file_hash FROM {table} WHERE file_data IS NULL" for table in BLOB_TABLES))
+  return {row["file_hash"] for row in rows}
+
+async def fetch_crawl_state(conn):
+  """Состояние прошлых обходов: url страницы или изображения -> хэш содержимого, ETag, Last-Modified."""
+  return await conn.fetch("SELECT url, file_hash, etag, last_modified FROM crawl_state")
+
+async def upsert_crawl_state(conn, records):
+  """Сохранить состояние обхода, records - кортежи (url, file_hash, etag, last_modified)."""
+  await conn.executemany("""
+    INSERT INTO crawl_state (url, file_hash, etag, last_modified)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (url) DO UPDATE SET file_hash = EXCLUDED.file_hash, etag = EXCLUDED.etag,
+      last_modified = EXCLUDED.last_modified, fetched_at = now()
+  """, records)
+
+async def submit_job(conn, job_type, params, dedupe_key):
+  """Поставить задание в очередь. Если такое же задание уже в очереди или выполняется,
+  новое не создается. Возвращает (id задания, создано ли новое)."""
+  while True:
+    job_id = await conn.fetchval("""
+      INSERT INTO jobs (job_type, params, dedupe_key)
+      VALUES ($1, $2::jsonb, $3)
+      ON CONFLICT (dedupe_key) WHERE state IN ('queued', 'running') DO NOTHING
+      RETURNING id
+    """, job_type, json.dumps(params), dedupe_key)
+    if job_id is not None:
+      return job_id, True
+    job_id = await conn.fetchval("""
+      SELECT id FROM jobs WHERE dedupe_key = $1 AND state IN ('queued', 'running')
+    """, dedupe_key)
+    # Задание могло завершиться между двумя запросами - тогда пробуем вставить снова
+    if job_id is not None:
+      return job_id, False
+
+async def claim_job(conn, job_type):
+  """Взять из очереди самое старое задание данного типа, параллельные воркеры получают разные задания."""
+  row = await conn.fetchrow("""
+    UPDATE jobs SET state = 'running', started_at = now(), updated_at = now(), heartbeat_at = now()
+    WHERE id = (
+      SELECT id FROM jobs WHERE job_type = $1 AND state = 'queued'
+      ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, params
+  """, job_type)
+  if row is None:
+    return None
+  return row["id"], json.loads(row["params"]) if row["params"] is not None else {}
+
+async def update_job_progress(conn, job_id, processed, total=None):
+  await conn.execute("""
+    UPDATE jobs SET processed = $2, total = COALESCE($3, total), updated_at = now() WHERE id = $1
+  """, job_id, processed, total)
+
+async def heartbeat_job(conn, job_id):
+  """Отметка о том, что задание еще выполняется (продление аренды)."""
+  await conn.execute("UPDATE jobs SET heartbeat_at = now() WHERE id = $1 AND state = 'running'", job_id)
+
+async def finish_job(conn, job_id, state, error=None):
+  """Записать результат задания. Результат записывает первый из сервиса и manager, повторная запись не меняет его."""
+  await conn.execute("""
+    UPDATE jobs SET state = $2, error = $3, updated_at = now(), finished_at = now() WHERE id = $1 AND state = 'running'
+  """, job_id, state, error)
+
+async def requeue_job(conn, job_id):
+  """Вернуть выполняющееся задание в очередь, например если сервис был недоступен."""
+  await conn.execute("""
+    UPDATE jobs SET state = 'queued', started_at = NULL, updated_at = now() WHERE id = $1 AND state = 'running'
+  """, job_id)
+
+async def requeue_expired_jobs(conn, lease):
+  """Вернуть в очередь выполняющиеся задания без отметки heartbeat_at дольше lease секунд:
+  их выполнение прервано остановкой сервиса или manager. Возвращает строки (id, job_type)."""
+  return await conn.fetch("""
+    UPDATE jobs SET state = 'queued', started_at = NULL, updated_at = now()
+    WHERE state = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < now() - make_interval(secs => $1))
+    RETURNING id, job_type
+  """, float(lease))
+
+async def fetch_job(conn, job_id):
+  return await conn.fetchrow("""
+    SELECT id, job_type, params, state, processed, total, error, created_at, started_at, updated_at, heartbeat_at, finished_at
+    FROM jobs WHERE id = $1
+  """, job_id)
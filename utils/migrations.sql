@@ -0,0 +1,56 @@
+-- Обновление схемы существующей базы до db-scripts/setup_db.sql.
+-- setup_db.sql выполняется только при создании тома postgres, эти шаги - при каждом запуске сервисов
+-- (database.migrate), поэтому все они повторяемы
+
+ALTER TABLE scrapped_images ADD COLUMN IF NOT EXISTS phash BIGINT;
+
+ALTER TABLE selected_images ADD COLUMN IF NOT EXISTS file_hash TEXT;
+ALTER TABLE selected_images ADD COLUMN IF NOT EXISTS predicted_class TEXT;
+ALTER TABLE selected_images ADD COLUMN IF NOT EXISTS predicted_class_version TEXT;
+
+ALTER TABLE pyramid_images ADD COLUMN IF NOT EXISTS file_hash TEXT;
+
+CREATE TABLE IF NOT EXISTS image_features (
+    selected_image_id INT,
+    model_version TEXT,
+    data BYTEA,
+    PRIMARY KEY (selected_image_id, model_version),
+    FOREIGN KEY (selected_image_id) REFERENCES selected_images(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS crawl_state (
+    url TEXT PRIMARY KEY,
+    file_hash TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at TIMESTAMP DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id SERIAL PRIMARY KEY,
+    job_type TEXT NOT NULL,
+    params JSONB,
+    dedupe_key TEXT,
+    state TEXT NOT NULL DEFAULT 'queued',
+    processed INT NOT NULL DEFAULT 0,
+    total INT,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT now(),
+    started_at TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT now(),
+    heartbeat_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP;
+
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_dedupe_key ON jobs (dedupe_key) WHERE state IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (job_type, id) WHERE state = 'queued';
+
+CREATE TABLE IF NOT EXISTS image_renditions (
+    selected_image_id INT,
+    size INT,
+    data BYTEA,
+    PRIMARY KEY (selected_image_id, size),
+    FOREIGN KEY (selected_image_id) REFERENCES selected_images(id) ON DELETE CASCADE
+);
@@ -1,16 +1,39 @@
 from pydantic import BaseModel
+from typing import List, Optional
 
 class ScraperParams(BaseModel):
   start_url: str
   max_images: int
+  job_id: Optional[int] = None
 
 class PyramidParams(BaseModel):
   first_image_id: int
   second_image_id: int
+  job_id: Optional[int] = None
+
+class JobParams(BaseModel):
+  job_id: Optional[int] = None
 
 class ImageIdParams(BaseModel):
   image_id: int
 
+class ClassifyBulkParams(BaseModel):
+  image_ids: Optional[List[int]] = None
+  all_images: bool = False
+
+class HsvParams(BaseModel):
+  image_id: int
+  top_n: int = 3
+
+class CiedeParams(BaseModel):
+  image_id: int
+  shortlist: Optional[int] = None
+  exhaustive: bool = False
+
+class CiedeRecallParams(BaseModel):
+  image_ids: List[int]
+  shortlist: Optional[int] = None
+
 class PhotoFinderParams(BaseModel):
   image_id: int
   n_neighbors: int
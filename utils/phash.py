@@ -0,0 +1,98 @@
+import io, imagehash
+from PIL import Image
+
+HASH_MASK = (1 << 64) - 1
+
+def phash_int(file_data):
+  """Перцептивный хэш изображения как знаковое 64-битное целое (для столбца BIGINT)."""
+  with Image.open(io.BytesIO(file_data)) as img:
+    value = int(str(imagehash.phash(img)), 16)
+  return value - (1 << 64) if value >= (1 << 63) else value
+
+def hamming(first, second):
+  """Расстояние Хэмминга между двумя 64-битными хэшами."""
+  return bin((first ^ second) & HASH_MASK).count("1")
+
+class BKTree:
+  """BK-дерево по расстоянию Хэмминга: поиск хэша на расстоянии < threshold без перебора всех хэшей."""
+
+  def __init__(self):
+    self._root = None
+    self._size = 0
+
+  def __len__(self):
+    return self._size
+
+  def add(self, hash_value, value):
+    # Узел: [хэш, значение, потомки по расстоянию, признак удаления]
+    node = [hash_value, value, {}, False]
+    self._size += 1
+    if self._root is None:
+      self._root = node
+      return
+    current = self._root
+    while True:
+      distance = hamming(hash_value, current[0])
+      child = current[2].get(distance)
+      if child is None:
+        current[2][distance] = node
+        return
+      current = child
+
+  def _find_node(self, hash_value, threshold):
+    if self._root is None:
+      return None
+    stack = [self._root]
+    while stack:
+      node = stack.pop()
+      node_hash, _, children, removed = node
+      distance = hamming(hash_value, node_hash)
+      if distance < threshold and not removed:
+        return node
+      # По неравенству треугольника подходящие хэши могут быть только в поддеревьях
+      # с расстоянием до узла в интервале (distance - threshold, distance + threshold)
+      for child_distance, child in children.items():
+        if distance - threshold < child_distance < distance + threshold:
+          stack.append(child)
+    return None
+
+  def find(self, hash_value, threshold):
+    """Значение любого хэша на расстоянии < threshold или None."""
+    node = self._find_node(hash_value, threshold)
+    return None if node is None else node[1]
+
+  def find_or_add(self, hash_value, value, threshold):
+    """Значение похожего хэша или None, если похожего нет (тогда хэш добавляется в дерево).
+    Проверка и добавление выполняются без точек переключения, поэтому атомарны для корутин."""
+    existing = self.find(hash_value, threshold)
+    if existing is None:
+      self.add(hash_value, value)
+    return existing
+
+  def discard(self, hash_value, value):
+    """Пометить хэш удаленным (узел остается в дереве для навигации)."""
+    # Узел лежит на том же пути, по которому он добавлялся
+    current = self._root
+    while current is not None:
+      distance = hamming(hash_value, current[0])
+      if distance == 0 and current[1] == value and not current[3]:
+        current[3] = True
+        self._size -= 1
+        return
+      current = current[2].get(distance)
+
+def split_duplicates(rows, threshold):
+  """Разделение строк (id, phash) на оставляемые изображения и дубликаты: изображение - дубликат,
+  если среди оставленных до него есть хэш на расстоянии Хэмминга < threshold.
+  Возвращает список id оставленных и список пар (id оригинала, id дубликата)."""
+  duplicates = []
+  unique_images = []
+  tree = BKTree()
+  for row in rows:
+    original_id = tree.find(row["phash"], threshold)
+    if original_id is not None:
+      duplicates.append((original_id, row["id"]))
+    else:
+      tree.add(row["phash"], row["id"])
+      unique_images.append(row["id"])
+  return unique_images, duplicates
@@ -0,0 +1,66 @@
+import asyncio, os, time
+from . import database
+
+class JobProgress:
+  # Отчет о ходе задания в таблицу jobs, которую читает manager (GET /jobs/{id}).
+  # Записи в базу не чаще одного раза в interval секунд; без job_id отчет не ведется.
+  # Пока задание выполняется внутри async with, сервис раз в JOBS_HEARTBEAT_INTERVAL секунд продлевает
+  # аренду (jobs.heartbeat_at) и при выходе сам записывает результат. Поэтому перезапуск manager
+  # не приводит к повторному запуску задания, а задание остановленного сервиса возвращается в очередь
+  def __init__(self, ctx, job_id, interval=1.0):
+    self.ctx = ctx
+    self.job_id = job_id
+    self.interval = interval
+    self.heartbeat_interval = float(os.getenv("JOBS_HEARTBEAT_INTERVAL", 10))
+    self.processed = 0
+    self.total = None
+    self._reported_at = 0.0
+    self._heartbeat = None
+
+  async def __aenter__(self):
+    if self.job_id is not None:
+      self._heartbeat = asyncio.create_task(self._beat())
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    if self._heartbeat is not None:
+      self._heartbeat.cancel()
+      await asyncio.gather(self._heartbeat, return_exceptions=True)
+    # При остановке сервиса результат не записывается: аренда истечет, и manager вернет задание в очередь
+    if self.job_id is None or exc_type is asyncio.CancelledError:
+      return
+    state, error = ("done", None) if exc is None else ("failed", str(exc) or exc_type.__name__)
+    try:
+      async with self.ctx.db_handle.acquire() as conn:
+        await database.finish_job(conn, self.job_id, state, error)
+    except Exception as e:
+      self.ctx.logger.error(f"Не удалось сохранить результат задания {self.job_id}: {e}")
+
+  async def _beat(self):
+    while True:
+      await asyncio.sleep(self.heartbeat_interval)
+      try:
+        async with self.ctx.db_handle.acquire() as conn:
+          await database.heartbeat_job(conn, self.job_id)
+      except Exception as e:
+        self.ctx.logger.error(f"Не удалось продлить аренду задания {self.job_id}: {e}")
+
+  async def update(self, processed=None, total=None, force=False):
+    if processed is not None:
+      self.processed = processed
+    if total is not None:
+      self.total = total
+    if self.job_id is None:
+      return
+    now = time.monotonic()
+    if not force and now - self._reported_at < self.interval:
+      return
+    self._reported_at = now
+    try:
+      async with self.ctx.db_handle.acquire() as conn:
+        await database.update_job_progress(conn, self.job_id, self.processed, self.total)
+    except Exception as e:
+      self.ctx.logger.error(f"Не удалось сохранить прогресс задания {self.job_id}: {e}")
+
+  async def done(self):
+    await self.update(force=True)